@@ -1,67 +1,189 @@
 import hashlib
+import io
 import logging
-import threading
+import os
+import time
 from urllib.parse import urlencode
 
 from flask import (
+    Blueprint,
+    abort,
     Flask,
+    Response,
+    jsonify,
     render_template,
+    current_app,
     flash,
+    g,
+    make_response,
     redirect,
+    request,
+    session,
     url_for,
 )
-from wtforms.validators import DataRequired, Email
+from wtforms.validators import DataRequired, Email, ValidationError
 from wtforms.fields import *
+from wtforms.widgets import Select
 from flask_wtf import CSRFProtect, FlaskForm
 from flask_bootstrap import Bootstrap5
-from label_voucher import print_appuio_voucher, print_servala_voucher
-from label_raffle import print_raffle
-
-
-from brother_ql_web.configuration import (
-    Configuration,
-    ServerConfiguration,
-    PrinterConfiguration,
-    LabelConfiguration,
-    WebsiteConfiguration,
+from label_voucher import render_appuio_voucher, render_servala_voucher
+from label_raffle import render_raffle
+from label_render import FragmentCache, clear_fragment_cache
+from lead_store import DuplicateLead
+from metrics import CONTENT_TYPE, Counter, Gauge, Histogram, render as render_metrics
+from print_queue import PrintQueueFull
+from services import (
+    background_started,
+    get_lead_store,
+    get_lead_sync,
+    get_odoo_cache,
+    get_odoo_client,
+    get_print_queue,
+    get_printer_config,
+    start_background,
 )
+from static_assets import StaticAssets
+from tracing import SERVER, current, tracer
 
-from odoo_client import *
 from config import *
 from utils import *
 
-app = Flask(__name__)
-app.secret_key = config.FLASK_APP_SECRET_KEY
-csrf = CSRFProtect(app)
-bootstrap = Bootstrap5(app)
+bp = Blueprint("contactform", __name__)
+csrf = CSRFProtect()
+bootstrap = Bootstrap5()
+static_assets = StaticAssets()
+
+# Probes and scrapes would only clutter the traces
+_UNTRACED_ENDPOINTS = {"contactform.healthz", "contactform.metrics_endpoint"}
+
+# Every kind of label the app prints, by their names in the print queue
+LABEL_KINDS = {
+    "raffle": "Raffle Ticket",
+    "appuio": "APPUiO Voucher",
+    "servala": "Servala Voucher",
+}
 
-# Basic styling
-app.config["BOOTSTRAP_BOOTSWATCH_THEME"] = "sandstone"
-app.config["BOOTSTRAP_BTN_SIZE"] = "lg"
-app.config["BOOTSTRAP_SERVE_LOCAL"] = True
+# Leads per page of the reprint page
+_REPRINT_PAGE_SIZE = 50
 
-# Initialize Odoo client and look up campaign and source IDs
-odoo_client = OdooClient(
-    config.ODOO_URL, config.ODOO_DB, config.ODOO_USERNAME, config.ODOO_PASSWORD
+REQUEST_SECONDS = Histogram(
+    "contactform_request_seconds",
+    "Time to handle a request",
+    ["endpoint", "method", "status"],
+)
+LEADS_SUBMITTED = Counter("contactform_leads_submitted_total", "Leads submitted")
+DUPLICATE_SUBMISSIONS = Counter(
+    "contactform_duplicate_submissions_total",
+    "Form submissions rejected because the e-mail was already submitted",
+)
+PRINT_QUEUE_JOBS = Gauge(
+    "contactform_print_queue_jobs",
+    "Labels waiting in the reprint batch, to be rendered or in the spool waiting for the printer",
+    ["state"],
+)
+ODOO_OUTBOX_LEADS = Gauge(
+    "contactform_odoo_outbox_leads",
+    "Leads waiting to be created in Odoo, and those of them that failed before",
+    ["state"],
 )
-try:
-    config.lookup_ids(odoo_client)
-except ValueError as e:
-    logging.error(e)
-    exit(1)
-
-# Configure printer
-printer_config = Configuration(
-    server=ServerConfiguration,
-    printer=PrinterConfiguration(
-        model="QL-820NWB", printer=f"tcp://{config.PRINTER_IP}"
-    ),
-    label=LabelConfiguration(
-        default_size="54",
-        default_orientation="standard",
-    ),
-    website=WebsiteConfiguration,
+ODOO_OUTBOX_LAG_SECONDS = Gauge(
+    "contactform_odoo_outbox_lag_seconds",
+    "Age of the oldest lead waiting to be created in Odoo",
 )
+ODOO_CIRCUIT_OPEN = Gauge(
+    "contactform_odoo_circuit_open",
+    "1 while calls to Odoo fail fast because it was unreachable",
+)
+
+
+def create_app():
+    """Create the contactform app.
+
+    Nothing expensive happens here: Odoo, the stores and the print queue are
+    set up on first use or by start_background(), so the app serves the
+    health probe right after the process started.
+    """
+    app = Flask(__name__)
+    app.secret_key = config.FLASK_APP_SECRET_KEY
+    csrf.init_app(app)
+    bootstrap.init_app(app)
+    static_assets.init_app(app)
+
+    # Basic styling
+    app.config["BOOTSTRAP_BOOTSWATCH_THEME"] = "sandstone"
+    app.config["BOOTSTRAP_BTN_SIZE"] = "lg"
+    app.config["BOOTSTRAP_SERVE_LOCAL"] = True
+
+    app.register_blueprint(bp)
+    return app
+
+
+@bp.before_app_request
+def ensure_background():
+    g.request_started = time.monotonic()
+    # Set up the services unless gunicorn's post_worker_init hook already did
+    if not background_started():
+        start_background()
+
+
+@bp.before_app_request
+def start_trace():
+    if request.endpoint is None or request.endpoint in _UNTRACED_ENDPOINTS:
+        return
+    if request.endpoint.endswith("static"):
+        return
+    g.span = tracer.start(
+        f"{request.method} {request.url_rule.rule}",
+        attributes={
+            "http.request.method": request.method,
+            "http.route": request.url_rule.rule,
+            "url.path": request.path,
+        },
+        kind=SERVER,
+    )
+
+
+@bp.after_app_request
+def observe_request(response):
+    if "request_started" in g:
+        REQUEST_SECONDS.observe(
+            time.monotonic() - g.request_started,
+            request.endpoint,
+            request.method,
+            response.status_code,
+        )
+    if g.get("span") is not None:
+        g.span.set_attribute("http.response.status_code", response.status_code)
+    return response
+
+
+@bp.teardown_app_request
+def finish_trace(error):
+    tracer.finish(g.pop("span", None), error)
+
+
+class CachedSelect(Select):
+    """Select widget rendering the options only once for the same choices.
+
+    The country list has a few hundred entries, rendering them for every
+    request of the form page is the bulk of its cost. The choices must not
+    be changed in place, replacing them renders the options again.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._fragments = FragmentCache(maxsize=16)
+
+    def __call__(self, field, **kwargs):
+        # Holding on to the choices keeps their id from being reused
+        key = (id(field.choices), field.data, tuple(sorted(kwargs.items())))
+        render = super().__call__
+        choices, html = self._fragments.get(
+            key, lambda: (field.choices, render(field, **kwargs))
+        )
+        if choices is not field.choices:
+            return render(field, **kwargs)
+        return html
 
 
 class LeadForm(FlaskForm):
@@ -70,10 +192,15 @@ class LeadForm(FlaskForm):
     company = StringField("Company")
     job_position = StringField("Job Position")
     phone = TelField()
-    country = SelectField("Country", choices=load_countries(odoo_client))
+    country = SelectField("Country", widget=CachedSelect())
     notes = TextAreaField("What can VSHN help you with?", render_kw={"rows": 5})
     submit = SubmitField()
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # As is, WTForms would copy the cached countries into a new list
+        self.country.choices = get_odoo_cache().countries()
+
 
 class ConfigForm(FlaskForm):
     campaign_name = StringField("Campaign Name *", validators=[DataRequired()])
@@ -88,38 +215,179 @@ class ConfigForm(FlaskForm):
     submit = SubmitField("Save Changes")
 
 
-def is_duplicate_submission(email, csv_file_path):
+class ReprintForm(FlaskForm):
+    kind = SelectField(choices=list(LABEL_KINDS.items()))
+
+
+class BulkPrintForm(FlaskForm):
+    first_lead = IntegerField("First Lead ID *", validators=[DataRequired()])
+    last_lead = IntegerField("Last Lead ID *", validators=[DataRequired()])
+    submit = SubmitField("Print Raffle Tickets")
+
+    def validate_last_lead(self, field):
+        if self.first_lead.data is None:
+            return
+        if field.data < self.first_lead.data:
+            raise ValidationError("Must not be lower than the first lead ID.")
+        if field.data - self.first_lead.data >= config.PRINT_BATCH_MAX_LABELS:
+            raise ValidationError(
+                f"At most {config.PRINT_BATCH_MAX_LABELS} labels can be printed at once."
+            )
+
+
+def _page_files(app):
+    for scaffold in [app, *app.blueprints.values()]:
+        for folder in (scaffold.template_folder, scaffold.static_folder):
+            if not folder:
+                continue
+            folder = os.path.join(scaffold.root_path, folder)
+            for root, dirs, files in sorted(os.walk(folder)):
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    yield os.path.relpath(path, folder), path
+
+
+def build_id(app):
+    """Hash of the templates and static files of the app and its blueprints.
+
+    Computed once per process, it changes with every deployment that changes
+    what the pages are made of.
+    """
+    if "contactform_build_id" not in app.extensions:
+        digest = hashlib.sha256()
+        for name, path in _page_files(app):
+            with open(path, "rb") as f:
+                digest.update(f"{name}:{hashlib.sha256(f.read()).hexdigest()}".encode())
+        app.extensions["contactform_build_id"] = digest.hexdigest()[:16]
+    return app.extensions["contactform_build_id"]
+
+
+def form_etag(version):
+    """ETag of the empty lead form for the current session.
+
+    The page only changes with the country list and with a deployment, apart
+    from the CSRF token. The token stays valid for WTF_CSRF_TIME_LIMIT, so
+    the ETag changes every half of that, which makes sure a page revalidated
+    from the browser cache never carries an expired token.
+    """
+    token = session.get("csrf_token")
+    if token is None:
+        return None
+    lifetime = current_app.config.get("WTF_CSRF_TIME_LIMIT", 3600) or 3600
+    period = int(time.time() // (lifetime / 2))
+    build = build_id(current_app)
+    return hashlib.sha256(f"{token}:{version}:{period}:{build}".encode()).hexdigest()
+
+
+def render_lead_form(form):
+    odoo_cache = get_odoo_cache()
+    version = odoo_cache.version
+    # Flashed messages are shown once, so those pages can't be cached, neither
+    # can a form whose countries were replaced by a refresh in the meantime
+    if (
+        request.method != "GET"
+        or "_flashes" in session
+        or form.country.choices is not odoo_cache.countries()
+    ):
+        return render_template("form.html", form=form)
+
+    etag = form_etag(version)
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = make_response(render_template("form.html", form=form))
+        # Rendering the form put a CSRF token into a new session
+        etag = form_etag(version)
+    # Without CSRF protection there is no token to tie the ETag to
+    if etag is not None:
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
+
+
+def label_kinds():
+    """The labels printed for a submission with the current configuration."""
+    kinds = []
+    if config.VOUCHER_TYPE == "appuio":
+        kinds.append("appuio")
+    elif config.VOUCHER_TYPE == "servala":
+        if not config.SERVALA_VOUCHER_CODE:
+            logging.error(
+                "VOUCHER_TYPE=servala but SERVALA_VOUCHER_CODE is empty; skipping voucher print"
+            )
+        else:
+            kinds.append("servala")
+    if config.PRINT_RAFFLE_TICKET:
+        kinds.append("raffle")
+    return kinds
+
+
+def label_job(kind, name, company, email, phone, voucher_code):
+    """The print queue job (kind, name, render function, *its arguments) of a label."""
+    printer_config = get_printer_config()
+    if kind == "appuio":
+        return (
+            kind,
+            name,
+            render_appuio_voucher,
+            name,
+            company,
+            email,
+            phone,
+            voucher_code,
+            config,
+            printer_config,
+        )
+    if kind == "servala":
+        return (
+            kind,
+            name,
+            render_servala_voucher,
+            name,
+            voucher_code,
+            config,
+            printer_config,
+        )
+    return (kind, name, render_raffle, name, voucher_code, config, printer_config)
+
+
+def lead_label_job(kind, lead):
+    """The print queue job of a label for a lead from the lead store."""
+    return label_job(
+        kind,
+        lead["contact_name"] or "",
+        lead["company_name"] or "",
+        lead["email"] or "",
+        lead["phone"] or "",
+        lead["voucher_code"] or "",
+    )
+
+
+def is_duplicate_submission(email):
     """Check if the email has already been submitted."""
-    try:
-        with open(csv_file_path, mode="r") as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                if row["Email"] == email:
-                    return True
-    except FileNotFoundError:
-        # If the CSV file does not exist, treat as no duplicates
-        pass
-    return False
-
-
-@app.route("/", methods=["GET", "POST"])
+    return get_lead_store().exists(email)
+
+
+@bp.route("/", methods=["GET", "POST"])
 def index():
     form = LeadForm()
 
     if form.validate_on_submit():
         # Check if the form submission is a duplicate
-        if is_duplicate_submission(form.email.data, config.CSV_FILE_PATH):
+        if is_duplicate_submission(form.email.data):
+            DUPLICATE_SUBMISSIONS.inc()
             flash(
                 "You have already submitted the form. Duplicate submissions are not allowed.",
                 "warning",
             )
-            return redirect(url_for("index"))
+            return redirect(url_for(".index"))
 
         # Generate a random voucher code for APPUiO
         voucher_code = random_word(6)
 
-        # Append data to CSV file
-        csv_data = {
+        # Store the lead
+        lead_data = {
             "Opportunity": f"Event Lead: {form.name.data}",
             "Contact Name": form.name.data,
             "Email": form.email.data,
@@ -133,35 +401,43 @@ def index():
             "Source": config.SOURCE_NAME,
             "VoucherCode": voucher_code,
         }
-        append_to_csv(csv_data, config.CSV_FILE_PATH)
-
+        odoo_values = None
         if config.ODOO_CREATELEAD_ENABLED:
             voucher_label = (
                 "APPUiO Voucher Code"
                 if config.VOUCHER_TYPE == "appuio"
                 else "Raffle Code"
             )
-            # Create lead in Odoo
-            try:
-                lead_id = odoo_client.create(
-                    "crm.lead",
-                    {
-                        "name": f"Event Lead: {form.name.data}",
-                        "contact_name": form.name.data,
-                        "email_from": form.email.data,
-                        "function": form.job_position.data,
-                        "partner_name": form.company.data,
-                        "country_id": form.country.data,
-                        "phone": form.phone.data,
-                        "description": f"{form.notes.data}<br><br>{voucher_label}: {voucher_code}",
-                        "campaign_id": config.CAMPAIGN_ID,
-                        "source_id": config.SOURCE_ID,
-                        "tag_ids": [(4, config.TAG_ID)],
-                    },
-                )
-                logging.debug(f"Created Lead ID: {lead_id}")
-            except Exception as e:
-                logging.error(f"Couldn't create Lead in Odoo: {e}")
+            odoo_values = {
+                "name": f"Event Lead: {form.name.data}",
+                "contact_name": form.name.data,
+                "email_from": form.email.data,
+                "function": form.job_position.data,
+                "partner_name": form.company.data,
+                "country_id": form.country.data or False,
+                "phone": form.phone.data,
+                "description": f"{form.notes.data}<br><br>{voucher_label}: {voucher_code}",
+            }
+            # Otherwise the sync worker fills them in once they are known
+            if config.ids_resolved():
+                odoo_values["campaign_id"] = config.CAMPAIGN_ID
+                odoo_values["source_id"] = config.SOURCE_ID
+                odoo_values["tag_ids"] = [(4, config.TAG_ID)]
+        try:
+            with tracer.span("store lead"):
+                lead_id = get_lead_store().add(lead_data, odoo_values=odoo_values)
+        except DuplicateLead:
+            # Lost the race against a simultaneous submission of the same e-mail
+            DUPLICATE_SUBMISSIONS.inc()
+            flash(
+                "You have already submitted the form. Duplicate submissions are not allowed.",
+                "warning",
+            )
+            return redirect(url_for(".index"))
+
+        LEADS_SUBMITTED.inc()
+        if odoo_values is not None:
+            get_lead_sync().notify(lead_id, current())
 
         # Extract necessary form data
         name_data = form.name.data
@@ -169,41 +445,37 @@ def index():
         email_data = form.email.data
         phone_data = form.phone.data
 
-        if config.VOUCHER_TYPE == "appuio":
-            threading.Thread(
-                target=print_appuio_voucher,
-                args=(
-                    name_data,
-                    company_data,
-                    email_data,
-                    phone_data,
-                    voucher_code,
-                    config,
-                    printer_config,
-                ),
-            ).start()
-        elif config.VOUCHER_TYPE == "servala":
-            if not config.SERVALA_VOUCHER_CODE:
-                logging.error(
-                    "VOUCHER_TYPE=servala but SERVALA_VOUCHER_CODE is empty; skipping voucher print"
+        positions = []
+        try:
+            for kind in label_kinds():
+                positions.append(
+                    get_print_queue().submit(
+                        *label_job(
+                            kind,
+                            name_data,
+                            company_data,
+                            email_data,
+                            phone_data,
+                            voucher_code,
+                        )
+                    )
                 )
-            else:
-                threading.Thread(
-                    target=print_servala_voucher,
-                    args=(name_data, voucher_code, config, printer_config),
-                ).start()
+        except PrintQueueFull as e:
+            logging.error(f"Not printing labels for {name_data}: {e}")
+            flash(
+                "The printer is very busy right now, please ask us at the booth for your label.",
+                "warning",
+            )
 
         if config.PRINT_RAFFLE_TICKET:
-            threading.Thread(
-                target=print_raffle,
-                args=(name_data, voucher_code, config, printer_config),
-            ).start()
             flash(
                 "Thanks for submitting. Collect your raffle ticket and put it in the box!",
                 "success",
             )
         else:
             flash("Thanks for submitting", "success")
+        if positions and positions[0] > 1:
+            flash(f"Your label is #{positions[0]} in line.", "info")
 
         # Redirect to go.vshn.ch for retargeting pixel firing
         email_hash = hashlib.sha256(
@@ -218,10 +490,10 @@ def index():
         })
         return redirect(f"https://go.vshn.ch/?{params}")
     else:
-        return render_template("form.html", form=form)
+        return render_lead_form(form)
 
 
-@app.route("/config", methods=["GET", "POST"])
+@bp.route("/config", methods=["GET", "POST"])
 @requires_auth
 def config_endpoint():
     form = ConfigForm(
@@ -235,9 +507,12 @@ def config_endpoint():
 
     if form.validate_on_submit():
         try:
-            config.CAMPAIGN_ID = odoo_client.find_id_by_name(
+            config.CAMPAIGN_ID = get_odoo_client().find_id_by_name(
                 "utm.campaign", form.campaign_name.data
             )
+            get_odoo_cache().remember(
+                "utm.campaign", form.campaign_name.data, config.CAMPAIGN_ID
+            )
             config.CAMPAIGN_NAME = form.campaign_name.data
             config.VOUCHER_TYPE = form.voucher_type.data
             config.SERVALA_VOUCHER_CODE = form.servala_voucher_code.data
@@ -245,15 +520,128 @@ def config_endpoint():
             config.ODOO_CREATELEAD_ENABLED = form.odoo_leadcreation_enabled.data
             config.LABEL_HEADER = form.label_header.data
             save_config(config)
+            clear_fragment_cache()
             flash("Configuration updated successfully", "success")
         except Exception as e:
             flash(f"{e}", "error")
 
-        return redirect(url_for("config_endpoint"))
+        return redirect(url_for(".config_endpoint"))
 
     return render_template("form.html", form=form)
 
 
+@bp.route("/reprint", methods=["GET", "POST"])
+@requires_auth
+def reprint_endpoint():
+    bulk_form = BulkPrintForm()
+
+    if bulk_form.validate_on_submit():
+        leads = get_lead_store().between(
+            bulk_form.first_lead.data, bulk_form.last_lead.data
+        )
+        if leads:
+            pending = get_print_queue().submit_batch(
+                lead_label_job("raffle", lead) for lead in leads
+            )
+            logging.info(f"Bulk printing raffle tickets for {len(leads)} leads")
+            flash(
+                f"Printing {len(leads)} raffle tickets, {pending} labels are waiting in the batch.",
+                "success",
+            )
+        else:
+            flash("There are no leads with these IDs.", "warning")
+        return redirect(url_for(".reprint_endpoint"))
+
+    before = request.args.get("before", type=int)
+    leads = get_lead_store().recent(_REPRINT_PAGE_SIZE, before=before)
+    for lead in leads:
+        lead["submitted"] = time.strftime(
+            "%Y-%m-%d %H:%M", time.localtime(lead["created"])
+        )
+    return render_template(
+        "reprint.html",
+        leads=leads,
+        kinds=LABEL_KINDS,
+        before=before,
+        older=leads[-1]["id"] if len(leads) == _REPRINT_PAGE_SIZE else None,
+        bulk_form=bulk_form,
+        queue=get_print_queue().stats(),
+    )
+
+
+@bp.route("/reprint/<int:lead_id>", methods=["POST"])
+@requires_auth
+def reprint_lead(lead_id):
+    lead = get_lead_store().get(lead_id)
+    if lead is None:
+        abort(404)
+    form = ReprintForm()
+    if not form.validate_on_submit():
+        flash(f"Couldn't reprint the label: {form.errors}", "error")
+    elif form.kind.data == "servala" and not config.SERVALA_VOUCHER_CODE:
+        flash("Set a Servala voucher code in the configuration first.", "error")
+    else:
+        # Ahead of any bulk prints, someone is probably waiting for it
+        get_print_queue().submit_batch(
+            [lead_label_job(form.kind.data, lead)], first=True
+        )
+        logging.info(f"Reprinting {form.kind.data} label for lead {lead_id}")
+        flash(
+            f"Reprinting the {LABEL_KINDS[form.kind.data]} for {lead['contact_name']}.",
+            "success",
+        )
+    return redirect(
+        url_for(".reprint_endpoint", before=request.args.get("before", type=int))
+    )
+
+
+@bp.route("/leads.csv")
+@requires_auth
+def leads_export():
+    output = io.StringIO()
+    get_lead_store().export_csv(output)
+    return Response(
+        output.getvalue(),
+        mimetype="text/csv",
+        headers={"Content-Disposition": "attachment; filename=leads.csv"},
+    )
+
+
+@bp.route("/queue")
+@requires_auth
+def queue_endpoint():
+    return jsonify(get_print_queue().stats())
+
+
+@bp.route("/sync")
+@requires_auth
+def sync_endpoint():
+    return jsonify(get_lead_sync().stats())
+
+
+@bp.route("/metrics")
+@requires_auth
+def metrics_endpoint():
+    queue_stats = get_print_queue().stats()
+    PRINT_QUEUE_JOBS.set(queue_stats["rendering"], "rendering")
+    PRINT_QUEUE_JOBS.set(queue_stats["spooled"], "spooled")
+    PRINT_QUEUE_JOBS.set(queue_stats["batch"], "batch")
+    sync_stats = get_lead_sync().stats()
+    ODOO_OUTBOX_LEADS.set(sync_stats["pending"], "pending")
+    ODOO_OUTBOX_LEADS.set(sync_stats["failing"], "failing")
+    ODOO_OUTBOX_LAG_SECONDS.set(sync_stats["lag_seconds"])
+    ODOO_CIRCUIT_OPEN.set(int(sync_stats["odoo_circuit"] == "open"))
+    return Response(render_metrics(), content_type=CONTENT_TYPE)
+
+
+@bp.route("/healthz")
+def healthz():
+    return jsonify(status="ok", background_started=background_started())
+
+
+app = create_app()
+
+
 if __name__ == "__main__":
     flask_debug = True if config.LOG_LEVEL == "DEBUG" else False
     try:
@@ -3,6 +3,7 @@ import logging
 import json
 from dotenv import load_dotenv
 from odoo_client import OdooClient
+from printer_pool import DISPATCH_STRATEGIES
 
 
 class ConfigError(Exception):
@@ -14,7 +15,21 @@ class Config:
         load_dotenv()
         self.FLASK_APP_SECRET_KEY = self.get_env_var("FLASK_APP_SECRET_KEY")
         self.LOG_LEVEL = self.get_env_var("LOG_LEVEL", "INFO").upper()
+        # One or more printers, comma-separated, as host or host:port
         self.PRINTER_IP = self.get_env_var("PRINTER_IP")
+        self.PRINTERS = [ip.strip() for ip in self.PRINTER_IP.split(",") if ip.strip()]
+        if not self.PRINTERS:
+            raise ConfigError("PRINTER_IP must name at least one printer.")
+        self.PRINTER_DISPATCH = self.get_env_var(
+            "PRINTER_DISPATCH", "least-busy"
+        ).lower()
+        if self.PRINTER_DISPATCH not in DISPATCH_STRATEGIES:
+            raise ConfigError(
+                f"PRINTER_DISPATCH must be one of {', '.join(DISPATCH_STRATEGIES)}."
+            )
+        self.PRINTER_PROBE_INTERVAL = self.get_env_int_var(
+            "PRINTER_PROBE_INTERVAL", "10"
+        )
         self.ODOO_URL = self.get_env_var("ODOO_URL")
         self.ODOO_DB = self.get_env_var("ODOO_DB")
         self.ODOO_USERNAME = self.get_env_var("ODOO_USERNAME")
@@ -22,7 +37,9 @@ class Config:
         self.TAG_NAME = self.get_env_var("TAG_NAME")
         self.CAMPAIGN_NAME = self.get_env_var("CAMPAIGN_NAME")
         self.SOURCE_NAME = self.get_env_var("SOURCE_NAME")
-        self.CSV_FILE_PATH = self.get_env_var("CSV_FILE_PATH")
+        self.LEAD_DB_PATH = self.get_env_var("LEAD_DB_PATH", "leads.sqlite")
+        # Leads collected before the SQLite store, imported into an empty store
+        self.CSV_FILE_PATH = self.get_env_var("CSV_FILE_PATH", "")
         self.LABEL_HEADER = self.get_env_var("LABEL_HEADER", "Welcome")
         self.VOUCHER_TYPE = self.get_env_var("VOUCHER_TYPE", "appuio").lower()
         self.SERVALA_VOUCHER_CODE = self.get_env_var("SERVALA_VOUCHER_CODE", "")
@@ -32,6 +49,7 @@ class Config:
         self.ODOO_CREATELEAD_ENABLED = (
             self.get_env_var("ODOO_CREATELEAD_ENABLED", "true").lower() == "true"
         )
+        self.ODOO_SYNC_BATCH_SIZE = self.get_env_int_var("ODOO_SYNC_BATCH_SIZE", "50")
         self.CONFIG_FILE_PATH = self.get_env_var("CONFIG_FILE_PATH", "config.json")
         self.BASIC_AUTH_USERNAME = self.get_env_var("BASIC_AUTH_USERNAME")
         self.BASIC_AUTH_PASSWORD = self.get_env_var("BASIC_AUTH_PASSWORD")
@@ -49,6 +67,40 @@ class Config:
         self.SERVALA_LOGO_PATH = self.get_env_var(
             "SERVALA_LOGO_PATH", "contactform/static/images/servala-bw.png"
         )
+        self.LABEL_RENDERER = self.get_env_var("LABEL_RENDERER", "chromium").lower()
+        if self.LABEL_RENDERER not in ("chromium", "pillow"):
+            raise ConfigError("LABEL_RENDERER must be either chromium or pillow.")
+        self.RENDER_POOL_SIZE = self.get_env_int_var("RENDER_POOL_SIZE", "1")
+        self.RENDER_POOL_MAX_RENDERS = self.get_env_int_var(
+            "RENDER_POOL_MAX_RENDERS", "100"
+        )
+        self.PRINT_QUEUE_SIZE = self.get_env_int_var("PRINT_QUEUE_SIZE", "20")
+        self.PRINT_RENDER_WORKERS = self.get_env_int_var("PRINT_RENDER_WORKERS", "1")
+        self.PRINT_SPOOL_PATH = self.get_env_var(
+            "PRINT_SPOOL_PATH", "print_spool.sqlite"
+        )
+        # Reprints and bulk prints are fed to the printer at this many labels
+        # per minute, and only while fewer labels than this are in line
+        self.PRINT_BATCH_RATE = self.get_env_int_var("PRINT_BATCH_RATE", "20")
+        self.PRINT_BATCH_MAX_PENDING = self.get_env_int_var(
+            "PRINT_BATCH_MAX_PENDING", "2"
+        )
+        self.PRINT_BATCH_MAX_LABELS = self.get_env_int_var(
+            "PRINT_BATCH_MAX_LABELS", "200"
+        )
+        self.ODOO_POOL_SIZE = self.get_env_int_var("ODOO_POOL_SIZE", "4")
+        self.ODOO_TIMEOUT = self.get_env_int_var("ODOO_TIMEOUT", "30")
+        self.ODOO_CIRCUIT_FAILURES = self.get_env_int_var("ODOO_CIRCUIT_FAILURES", "5")
+        self.ODOO_CIRCUIT_RESET = self.get_env_int_var("ODOO_CIRCUIT_RESET", "30")
+        self.ODOO_CACHE_PATH = self.get_env_var("ODOO_CACHE_PATH", "odoo_cache.json")
+        self.ODOO_CACHE_TTL = self.get_env_int_var("ODOO_CACHE_TTL", "3600")
+        # Spans of each submission, none are recorded if empty
+        self.TRACE_FILE_PATH = self.get_env_var("TRACE_FILE_PATH", "")
+        # The form runs in a single gunicorn worker and scales with threads
+        self.GUNICORN_THREADS = self.get_env_int_var("GUNICORN_THREADS", "8")
+        self.GUNICORN_PRELOAD = (
+            self.get_env_var("GUNICORN_PRELOAD", "true").lower() == "true"
+        )
         self.TAG_ID = None
         self.CAMPAIGN_ID = None
         self.SOURCE_ID = None
@@ -68,11 +120,16 @@ class Config:
             raise ConfigError(f"Environment variable {name} must be an integer.")
 
     def lookup_ids(self, odoo_client):
-        self.CAMPAIGN_ID = odoo_client.find_id_by_name(
-            "utm.campaign", self.CAMPAIGN_NAME
+        self.CAMPAIGN_ID, self.SOURCE_ID, self.TAG_ID = odoo_client.find_ids(
+            [
+                ("utm.campaign", self.CAMPAIGN_NAME),
+                ("utm.source", self.SOURCE_NAME),
+                ("crm.tag", self.TAG_NAME),
+            ]
         )
-        self.SOURCE_ID = odoo_client.find_id_by_name("utm.source", self.SOURCE_NAME)
-        self.TAG_ID = odoo_client.find_id_by_name("crm.tag", self.TAG_NAME)
+
+    def ids_resolved(self):
+        return None not in (self.CAMPAIGN_ID, self.SOURCE_ID, self.TAG_ID)
 
     def load_config_file(self):
         if os.path.exists(self.CONFIG_FILE_PATH):
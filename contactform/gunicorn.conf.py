@@ -0,0 +1,21 @@
+# Gunicorn settings for the contactform, run with:
+#   gunicorn -c contactform/gunicorn.conf.py
+# Not imported as config, gunicorn would take that for its own setting
+from config import config as contactform_config
+
+wsgi_app = "app:app"
+# Threads rather than processes: the in-process print queue with its spool
+# and the lead sync worker must only exist once, a second worker would print
+# labels and create leads twice
+worker_class = "gthread"
+workers = 1
+threads = contactform_config.GUNICORN_THREADS
+# Import the app (stores, clients, templates) once in the master, workers
+# are forked from it ready to serve
+preload_app = contactform_config.GUNICORN_PRELOAD
+
+
+def post_worker_init(worker):
+    from services import start_background
+
+    start_background()
@@ -0,0 +1,399 @@
+import html
+import io
+import logging
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from dataclasses import astuple, dataclass, field
+
+import segno
+from PIL import Image, ImageDraw, ImageFont
+from brother_ql_web.font_helpers import get_fonts
+
+from metrics import Counter
+from printer import rasterize, to_bitmap
+from render_pool import data_uri, get_render_pool
+
+# Printable width of the 54mm endless tape in dots
+LABEL_WIDTH = 590
+
+# Margin browsers put around a <p> that contains an image (1em of 16px)
+_IMAGE_MARGIN = 16
+
+_BASE_CSS = """
+body, html {
+    margin: 0;
+    padding: 0;
+    height: 100%;
+    display: grid;
+    place-items: center;
+    font-family: sans-serif;
+    text-align: center;
+}
+p {
+    margin: 16px 0;
+}
+"""
+
+
+class FragmentCache:
+    """Small thread-safe LRU cache for pre-rendered label fragments."""
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, factory):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+        value = factory()
+        with self._lock:
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+LABEL_RASTERS = Counter(
+    "contactform_label_rasters_total",
+    "Labels turned into raster instructions, rendered or reused from the cache",
+    ["source"],
+)
+
+_fragments = FragmentCache()
+# Raster instructions of recent labels, a few dozen KB each
+_rasters = FragmentCache(maxsize=32)
+
+
+def clear_fragment_cache():
+    """Drop all cached fragments and rasters, e.g. after the label configuration changed."""
+    _fragments.clear()
+    _rasters.clear()
+
+
+def _file_key(path):
+    stat = os.stat(path)
+    return (path, stat.st_mtime_ns, stat.st_size)
+
+
+@dataclass(frozen=True)
+class Style:
+    font_size: int = 16
+    bold: bool = False
+    letter_spacing: int = 0
+    # None means the browser default for a paragraph: 1em
+    margin_top: int | None = None
+    margin_bottom: int | None = None
+    # Fraction of the label width for images, None keeps the natural size
+    width: float | None = None
+
+    @property
+    def top(self):
+        return self.font_size if self.margin_top is None else self.margin_top
+
+    @property
+    def bottom(self):
+        return self.font_size if self.margin_bottom is None else self.margin_bottom
+
+
+@dataclass
+class Text:
+    text: str
+    style: str
+    bold: bool = False
+    # Static texts don't change between labels and are rendered only once
+    static: bool = False
+
+
+@dataclass
+class Picture:
+    path: str
+    style: str | None = None
+
+
+@dataclass
+class QRCode:
+    data: str
+    scale: int
+    static: bool = False
+
+
+@dataclass
+class Layout:
+    """Renderer-independent description of a label: blocks stacked and centered."""
+
+    height: int
+    blocks: list
+    styles: dict[str, Style] = field(default_factory=dict)
+    width: int = LABEL_WIDTH
+
+
+def _qr_data_uri(block):
+    return segno.make_qr(block.data).png_data_uri(scale=block.scale)
+
+
+class HtmlRenderer:
+    """Renders a layout as HTML and paints it in the Chromium render pool."""
+
+    def __init__(self, config):
+        self.config = config
+
+    def css(self, layout):
+        return _fragments.get(
+            ("css", tuple(layout.styles.items())), lambda: self._css(layout.styles)
+        )
+
+    def _css(self, styles):
+        rules = [_BASE_CSS]
+        for name, style in styles.items():
+            if style.width is not None:
+                rules.append(f".{name} {{ width: {style.width * 100:g}%; }}")
+                continue
+            rules.append(
+                f".{name} {{"
+                f" font-size: {style.font_size}px;"
+                f" font-weight: {'bold' if style.bold else 'normal'};"
+                f" letter-spacing: {style.letter_spacing}px;"
+                f" margin: {style.top}px 0 {style.bottom}px 0;"
+                " }"
+            )
+        return "\n".join(rules)
+
+    def html(self, layout):
+        parts = []
+        for block in layout.blocks:
+            if isinstance(block, Picture):
+                src = _fragments.get(
+                    ("uri", *_file_key(block.path)), lambda: data_uri(block.path)
+                )
+                css_class = f' class="{block.style}"' if block.style else ""
+                parts.append(f'<p><img src="{src}"{css_class}></p>')
+            elif isinstance(block, QRCode):
+                if block.static:
+                    src = _fragments.get(
+                        ("qr-uri", block.data, block.scale),
+                        lambda: _qr_data_uri(block),
+                    )
+                else:
+                    src = _qr_data_uri(block)
+                parts.append(f'<p><img src="{src}"></p>')
+            else:
+                text = html.escape(block.text)
+                if block.bold:
+                    text = f"<strong>{text}</strong>"
+                parts.append(f'<p class="{block.style}">{text}</p>')
+        return f"<div>{''.join(parts)}</div>"
+
+    def render(self, layout):
+        png = get_render_pool(self.config).render(
+            html_str=self.html(layout),
+            css_str=self.css(layout),
+            size=(layout.width, layout.height),
+        )
+        return to_bitmap(Image.open(io.BytesIO(png)))
+
+
+class PillowRenderer:
+    """Composes a layout directly with Pillow, no browser involved."""
+
+    def __init__(self, config):
+        self.config = config
+        self._fonts = {}
+        self._font_paths = get_fonts()
+
+    def _font(self, size, bold):
+        key = (size, bold)
+        if key not in self._fonts:
+            styles = self._font_paths.get(self.config.LABEL_FONT_FAMILY, {})
+            path = styles.get("Bold" if bold else self.config.LABEL_FONT_STYLE)
+            path = path or styles.get(self.config.LABEL_FONT_STYLE)
+            if path:
+                self._fonts[key] = ImageFont.truetype(path, size)
+            else:
+                logging.warning(
+                    f"Font {self.config.LABEL_FONT_FAMILY} {self.config.LABEL_FONT_STYLE}"
+                    " not found, falling back to Pillow's default font"
+                )
+                self._fonts[key] = ImageFont.load_default(size)
+        return self._fonts[key]
+
+    def _text_width(self, font, text, letter_spacing):
+        return font.getlength(text) + letter_spacing * len(text)
+
+    def _wrap(self, text, font, letter_spacing, max_width):
+        lines = []
+        line = ""
+        for word in text.split():
+            candidate = f"{line} {word}" if line else word
+            if line and self._text_width(font, candidate, letter_spacing) > max_width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        lines.append(line)
+        return lines
+
+    def _text_block(self, block, style, width):
+        font = self._font(style.font_size, style.bold or block.bold)
+        ascent, descent = font.getmetrics()
+        line_height = ascent + descent
+        lines = self._wrap(block.text, font, style.letter_spacing, width)
+        image = Image.new("L", (width, line_height * len(lines)), 255)
+        draw = ImageDraw.Draw(image)
+        for i, line in enumerate(lines):
+            x = (width - self._text_width(font, line, style.letter_spacing)) / 2
+            y = i * line_height
+            if style.letter_spacing:
+                for char in line:
+                    draw.text((x, y), char, font=font, fill=0)
+                    x += font.getlength(char) + style.letter_spacing
+            else:
+                draw.text((x, y), line, font=font, fill=0)
+        return image
+
+    def _picture_block(self, block, style, width):
+        picture = Image.open(block.path)
+        picture.load()
+        if picture.mode in ("RGBA", "LA", "P"):
+            # Flatten transparency onto the white label background
+            picture = picture.convert("RGBA")
+            background = Image.new("RGBA", picture.size, (255, 255, 255, 255))
+            picture = Image.alpha_composite(background, picture)
+        picture = picture.convert("L")
+        if style is not None and style.width is not None:
+            target_width = round(width * style.width)
+            target_height = round(picture.height * target_width / picture.width)
+            picture = picture.resize((target_width, target_height), Image.LANCZOS)
+        # Dither once here, the printer's threshold then leaves it untouched
+        return picture.convert("1").convert("L")
+
+    def _qr_block(self, block):
+        buffer = io.BytesIO()
+        segno.make_qr(block.data).save(buffer, kind="png", scale=block.scale)
+        buffer.seek(0)
+        return Image.open(buffer).convert("L")
+
+    def _block(self, block, layout):
+        if isinstance(block, Picture):
+            style = layout.styles.get(block.style)
+            image = _fragments.get(
+                ("picture", *_file_key(block.path), style, layout.width),
+                lambda: self._picture_block(block, style, layout.width),
+            )
+            return image, _IMAGE_MARGIN, _IMAGE_MARGIN
+        if isinstance(block, QRCode):
+            if block.static:
+                image = _fragments.get(
+                    ("qr", block.data, block.scale), lambda: self._qr_block(block)
+                )
+            else:
+                image = self._qr_block(block)
+            return image, _IMAGE_MARGIN, _IMAGE_MARGIN
+        style = layout.styles[block.style]
+        if block.static:
+            image = _fragments.get(
+                (
+                    "text",
+                    block.text,
+                    block.bold,
+                    style,
+                    layout.width,
+                    self.config.LABEL_FONT_FAMILY,
+                    self.config.LABEL_FONT_STYLE,
+                ),
+                lambda: self._text_block(block, style, layout.width),
+            )
+        else:
+            image = self._text_block(block, style, layout.width)
+        return image, style.top, style.bottom
+
+    def render(self, layout):
+        rendered = [self._block(block, layout) for block in layout.blocks]
+
+        # Stack the blocks like a browser would: adjacent margins collapse,
+        # the outer margins of the first and last block are kept.
+        content_height = 0
+        positions = []
+        previous_bottom = 0
+        for index, (image, top, bottom) in enumerate(rendered):
+            content_height += top if index == 0 else max(previous_bottom, top)
+            positions.append(content_height)
+            content_height += image.height
+            previous_bottom = bottom
+        content_height += previous_bottom
+
+        label = Image.new("L", (layout.width, layout.height), 255)
+        offset = (layout.height - content_height) // 2
+        for (image, _, _), y in zip(rendered, positions):
+            label.paste(image, ((layout.width - image.width) // 2, offset + y))
+        return to_bitmap(label)
+
+
+RENDERERS = {
+    "chromium": HtmlRenderer,
+    "pillow": PillowRenderer,
+}
+
+_renderers = {}
+
+
+def get_renderer(config):
+    name = config.LABEL_RENDERER
+    if name not in _renderers:
+        _renderers[name] = RENDERERS[name](config)
+    return _renderers[name]
+
+
+def _layout_key(layout):
+    blocks = []
+    for block in layout.blocks:
+        if isinstance(block, Picture):
+            blocks.append(("picture", *_file_key(block.path), block.style))
+        else:
+            blocks.append((type(block).__name__, *astuple(block)))
+    return (
+        layout.height,
+        layout.width,
+        tuple(layout.styles.items()),
+        tuple(blocks),
+    )
+
+
+def render_label(layout, config, printer_config, label_kind):
+    """Render a layout into raster instructions for the printer.
+
+    Labels with identical content, e.g. reprints, reuse the raster
+    instructions of the first one instead of being rendered again.
+    """
+    key = (
+        config.LABEL_RENDERER,
+        config.LABEL_FONT_FAMILY,
+        config.LABEL_FONT_STYLE,
+        printer_config.printer.model,
+        _layout_key(layout),
+    )
+    cached = True
+
+    def render():
+        nonlocal cached
+        cached = False
+        label_image = get_renderer(config).render(layout)
+
+        # In DEBUG mode, keep the rendered label so it can be inspected
+        # without a printer.
+        if config.LOG_LEVEL == "DEBUG":
+            label_image.save(f"label_{label_kind}_{uuid.uuid4().hex}.png")
+
+        return rasterize(label_image, printer_config)
+
+    data = _rasters.get(key, render)
+    LABEL_RASTERS.inc("cached" if cached else "rendered")
+    return data
@@ -1,129 +1,26 @@
-import segno
 import urllib
 import logging
-import uuid
-import os
 
-from html2image import Html2Image
-from brother_ql_web.labels import (
-    LabelParameters,
-    generate_label,
-    print_label,
+from label_render import (
+    Layout,
+    Picture,
+    QRCode,
+    Style,
+    Text,
+    render_label,
 )
-from brother_ql.backends.network import BrotherQLBackendNetwork
 
-
-_LABEL_CSS = """
-body, html {
-    margin: 0;
-    padding: 0;
-    height: 100%;
-    display: grid;
-    place-items: center;
-    font-family: sans-serif;
-    text-align: center;
-}
-.logo {
-    width: 70%;
-}
-.logo_servala {
-    width: 55%;
-}
-.text {
-    font-size: 45px;
-}
-.text_small {
-    font-size: 35px;
-}
-.code {
-    font-size: 60px;
-    font-weight: bold;
-    letter-spacing: 4px;
+_LABEL_STYLES = {
+    "logo": Style(width=0.7),
+    "logo_servala": Style(width=0.55),
+    "text": Style(font_size=45),
+    "text_small": Style(font_size=35),
+    "code": Style(font_size=60, bold=True, letter_spacing=4),
+    "identifier": Style(font_size=24, bold=True, margin_top=10, margin_bottom=0),
 }
-.identifier {
-    font-size: 24px;
-    font-weight: bold;
-    color: #000;
-    margin: 10px 0 0 0;
-}
-"""
-
-
-def _render_and_print(
-    label_html,
-    load_files,
-    transient_files,
-    name_data,
-    config,
-    printer_config,
-    label_kind,
-):
-    unique_id = uuid.uuid4().hex
-    label_filename = f"label_{label_kind}_{unique_id}.png"
-    preview_filename = None
-
-    try:
-        hti = Html2Image(
-            size=(590, 1200),
-            custom_flags=[
-                "--default-background-color=FFFFFF",
-                "--hide-scrollbars",
-            ],
-        )
-        # https://github.com/vgalin/html2image/issues/174#issuecomment-2625720244
-        hti.browser.use_new_headless = True
-        for f in load_files:
-            hti.load_file(f)
-        hti.browser.print_command = True if config.LOG_LEVEL == "DEBUG" else False
-        hti.screenshot(
-            html_str=label_html,
-            css_str=_LABEL_CSS,
-            save_as=label_filename,
-        )
-
-        with open(label_filename, "rb") as label_image:
-            parameters = LabelParameters(
-                configuration=printer_config,
-                image=label_image.read(),
-                label_size="54",
-                high_quality=True,
-            )
-
-            logging.info(f"Printing {label_kind} voucher label for {name_data}")
-            preview_filename = (
-                f"print-preview-{label_kind}_{unique_id}.png"
-                if config.LOG_LEVEL == "DEBUG"
-                else None
-            )
-
-            qlr = generate_label(
-                parameters=parameters,
-                configuration=printer_config,
-                save_image_to=preview_filename,
-            )
-
-            print_label(
-                parameters=parameters,
-                qlr=qlr,
-                configuration=printer_config,
-                backend_class=BrotherQLBackendNetwork,
-            )
-    except Exception as e:
-        logging.error(f"Printing of {label_kind} voucher failed for {name_data}: {e}")
-    finally:
-        # In DEBUG mode, keep the rendered label image and the brother_ql
-        # preview so they can be inspected without a printer.
-        if config.LOG_LEVEL != "DEBUG":
-            if os.path.exists(label_filename):
-                os.remove(label_filename)
-            if preview_filename and os.path.exists(preview_filename):
-                os.remove(preview_filename)
-        for f in transient_files:
-            if os.path.exists(f):
-                os.remove(f)
 
 
-def print_appuio_voucher(
+def render_appuio_voucher(
     name_data,
     company_data,
     email_data,
@@ -132,20 +29,6 @@ def print_appuio_voucher(
     config,
     printer_config,
 ):
-    unique_id = uuid.uuid4().hex
-    qr_code_filename = f"appuio_voucher_qr_{unique_id}.png"
-
-    label_html = f"""\
-    <div>
-        <p><img src="appuio-bw.png" class="logo"></p>
-        <p class="text">Hi {name_data}<p>
-        <p class="text">Your personal voucher code to try out APPUiO:</p>
-        <p class="text"><strong>{voucher_code}</strong></p>
-        <p class="text_small">Register here: {config.APPUIO_SIGNUP_URL}</p>
-        <p><img src="{qr_code_filename}"></p>
-    </div>
-    """
-
     registration_url_parameters = (
         f"?voucher={voucher_code}"
         f"&name={urllib.parse.quote(name_data)}"
@@ -158,46 +41,52 @@ def print_appuio_voucher(
     signup_url = f"{config.APPUIO_SIGNUP_URL}{registration_url_parameters}"
     logging.debug(f"URL: {signup_url}")
 
-    qrcode = segno.make_qr(signup_url)
-    qrcode.save(qr_code_filename, scale=5)
+    layout = Layout(
+        height=1200,
+        styles=_LABEL_STYLES,
+        blocks=[
+            Picture(config.APPUIO_LOGO_PATH, "logo"),
+            Text(f"Hi {name_data}", "text"),
+            Text("Your personal voucher code to try out APPUiO:", "text", static=True),
+            Text(voucher_code, "text", bold=True),
+            Text(
+                f"Register here: {config.APPUIO_SIGNUP_URL}", "text_small", static=True
+            ),
+            QRCode(signup_url, scale=5),
+        ],
+    )
 
-    _render_and_print(
-        label_html=label_html,
-        load_files=[config.APPUIO_LOGO_PATH, qr_code_filename],
-        transient_files=[qr_code_filename],
-        name_data=name_data,
+    return render_label(
+        layout=layout,
         config=config,
         printer_config=printer_config,
         label_kind="appuio",
     )
 
 
-def print_servala_voucher(name_data, voucher_code, config, printer_config):
-    unique_id = uuid.uuid4().hex
-    qr_code_filename = f"servala_voucher_qr_{unique_id}.png"
-
-    label_html = f"""\
-    <div>
-        <p><img src="servala-bw.png" class="logo_servala"></p>
-        <p class="text">Hi {name_data}.</p>
-        <p class="text">Your personal voucher code to try Servala, the Sovereign App Store:</p>
-        <p class="code">{config.SERVALA_VOUCHER_CODE}</p>
-        <p class="text_small">Start here: {config.SERVALA_SIGNUP_URL}</p>
-        <p><img src="{qr_code_filename}"></p>
-        <p class="identifier">#{voucher_code}</p>
-    </div>
-    """
-
+def render_servala_voucher(name_data, voucher_code, config, printer_config):
     logging.debug(f"Servala QR URL: {config.SERVALA_SIGNUP_URL}")
 
-    qrcode = segno.make_qr(config.SERVALA_SIGNUP_URL)
-    qrcode.save(qr_code_filename, scale=8)
+    layout = Layout(
+        height=1200,
+        styles=_LABEL_STYLES,
+        blocks=[
+            Picture(config.SERVALA_LOGO_PATH, "logo_servala"),
+            Text(f"Hi {name_data}.", "text"),
+            Text(
+                "Your personal voucher code to try Servala, the Sovereign App Store:",
+                "text",
+                static=True,
+            ),
+            Text(config.SERVALA_VOUCHER_CODE, "code", static=True),
+            Text(f"Start here: {config.SERVALA_SIGNUP_URL}", "text_small", static=True),
+            QRCode(config.SERVALA_SIGNUP_URL, scale=8, static=True),
+            Text(f"#{voucher_code}", "identifier"),
+        ],
+    )
 
-    _render_and_print(
-        label_html=label_html,
-        load_files=[config.SERVALA_LOGO_PATH, qr_code_filename],
-        transient_files=[qr_code_filename],
-        name_data=name_data,
+    return render_label(
+        layout=layout,
         config=config,
         printer_config=printer_config,
         label_kind="servala",
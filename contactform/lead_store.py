@@ -0,0 +1,260 @@
+import csv
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from utils import normalize_email
+
+# Column layout of the leads CSV, kept for the export
+CSV_FIELDNAMES = [
+    "Opportunity",
+    "Contact Name",
+    "Email",
+    "Job Position",
+    "Company Name",
+    "Country",
+    "Phone",
+    "Notes",
+    "Tags",
+    "Campaign",
+    "Source",
+    "VoucherCode",
+]
+
+_COLUMNS = {
+    "Opportunity": "opportunity",
+    "Contact Name": "contact_name",
+    "Email": "email",
+    "Job Position": "job_position",
+    "Company Name": "company_name",
+    "Country": "country",
+    "Phone": "phone",
+    "Notes": "notes",
+    "Tags": "tags",
+    "Campaign": "campaign",
+    "Source": "source",
+    "VoucherCode": "voucher_code",
+}
+
+_LEAD_COLUMNS = ["id", "created", *_COLUMNS.values()]
+
+_INSERT = (
+    f"INSERT INTO leads (created, email_key, {', '.join(_COLUMNS.values())})"
+    f" VALUES (?, ?, {', '.join('?' * len(_COLUMNS))})"
+)
+
+
+class DuplicateLead(Exception):
+    pass
+
+
+class OutboxEntry:
+    def __init__(self, id, lead_id, values, attempts, created):
+        self.id = id
+        self.lead_id = lead_id
+        self.values = values
+        self.attempts = attempts
+        self.created = created
+
+    def __str__(self):
+        return f"lead {self.lead_id} ({self.values.get('email_from')})"
+
+
+class LeadStore:
+    """SQLite-backed store of the collected leads.
+
+    Runs in WAL mode so the form can write while exports read, and keeps a
+    unique index on the normalized e-mail address for the duplicate check.
+    Leads that still have to be created in Odoo wait in the outbox table,
+    written in the same transaction as the lead itself.
+    """
+
+    def __init__(self, path, import_csv_path=None):
+        self.path = path
+        self._local = threading.local()
+        db = self._db()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS leads (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created REAL NOT NULL,
+                email_key TEXT NOT NULL,
+                {', '.join(f'{column} TEXT' for column in _COLUMNS.values())}
+            )
+            """
+        )
+        db.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS leads_email_key ON leads (email_key)"
+        )
+        db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS odoo_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                lead_id INTEGER NOT NULL REFERENCES leads (id),
+                lead_values TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL,
+                created REAL NOT NULL,
+                last_error TEXT
+            )
+            """
+        )
+        if import_csv_path and os.path.isfile(import_csv_path) and not self.count():
+            self.import_csv(import_csv_path)
+
+    def _db(self):
+        # One connection per thread and process, sqlite3 connections can't be
+        # shared between threads or used across a fork
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def _values(self, data):
+        return (
+            time.time(),
+            normalize_email(data["Email"]),
+            *(data.get(field) for field in _COLUMNS),
+        )
+
+    def add(self, data, odoo_values=None):
+        """Store a lead given as a dict keyed by the CSV column names.
+
+        If odoo_values are given, the lead is also put in the outbox to be
+        created in Odoo with these values.
+        """
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            lead_id = db.execute(_INSERT, self._values(data)).lastrowid
+            if odoo_values is not None:
+                now = time.time()
+                db.execute(
+                    "INSERT INTO odoo_outbox (lead_id, lead_values, next_attempt, created)"
+                    " VALUES (?, ?, ?, ?)",
+                    (lead_id, json.dumps(odoo_values), now, now),
+                )
+        except sqlite3.IntegrityError:
+            db.execute("ROLLBACK")
+            raise DuplicateLead(f"{data['Email']} has already been submitted")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+        return lead_id
+
+    def exists(self, email):
+        return (
+            self._db()
+            .execute(
+                "SELECT 1 FROM leads WHERE email_key = ?", (normalize_email(email),)
+            )
+            .fetchone()
+            is not None
+        )
+
+    def count(self):
+        return self._db().execute("SELECT COUNT(*) FROM leads").fetchone()[0]
+
+    def _leads(self, query, params):
+        rows = self._db().execute(
+            f"SELECT {', '.join(_LEAD_COLUMNS)} FROM leads {query}", params
+        )
+        return [dict(zip(_LEAD_COLUMNS, row)) for row in rows]
+
+    def recent(self, limit, before=None):
+        """Return up to limit leads as dicts, newest first, optionally older than a lead ID."""
+        if before is None:
+            return self._leads("ORDER BY id DESC LIMIT ?", (limit,))
+        return self._leads("WHERE id < ? ORDER BY id DESC LIMIT ?", (before, limit))
+
+    def get(self, lead_id):
+        leads = self._leads("WHERE id = ?", (lead_id,))
+        return leads[0] if leads else None
+
+    def between(self, first_id, last_id):
+        """Return the leads with IDs from first_id to last_id, oldest first."""
+        return self._leads("WHERE id BETWEEN ? AND ? ORDER BY id", (first_id, last_id))
+
+    def import_csv(self, csv_file_path):
+        db = self._db()
+        with open(csv_file_path, mode="r") as csvfile:
+            rows = [self._values(row) for row in csv.DictReader(csvfile)]
+        db.execute("BEGIN")
+        # Counts the inserted rows only, not those ignored as duplicates
+        imported = db.executemany(
+            _INSERT.replace("INSERT", "INSERT OR IGNORE", 1), rows
+        ).rowcount
+        db.execute("COMMIT")
+        logging.info(f"Imported {imported} leads from {csv_file_path}")
+        if imported < len(rows):
+            logging.warning(
+                f"Skipped {len(rows) - imported} leads from {csv_file_path}"
+                " with an e-mail address already imported"
+            )
+
+    def export_csv(self, file):
+        """Write all leads in the original CSV layout to a file-like object."""
+        writer = csv.writer(file)
+        writer.writerow(CSV_FIELDNAMES)
+        writer.writerows(
+            self._db().execute(
+                f"SELECT {', '.join(_COLUMNS.values())} FROM leads ORDER BY id"
+            )
+        )
+
+    def outbox_due(self, limit):
+        """Return up to limit outbox entries that are due, oldest first."""
+        rows = self._db().execute(
+            "SELECT id, lead_id, lead_values, attempts, created FROM odoo_outbox"
+            " WHERE next_attempt <= ? ORDER BY id LIMIT ?",
+            (time.time(), limit),
+        )
+        return [
+            OutboxEntry(id, lead_id, json.loads(values), attempts, created)
+            for id, lead_id, values, attempts, created in rows
+        ]
+
+    def outbox_next_attempt(self):
+        """Return when the next outbox entry is due, None if the outbox is empty."""
+        return (
+            self._db()
+            .execute("SELECT MIN(next_attempt) FROM odoo_outbox")
+            .fetchone()[0]
+        )
+
+    def outbox_done(self, entries):
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        db.executemany(
+            "DELETE FROM odoo_outbox WHERE id = ?", [(entry.id,) for entry in entries]
+        )
+        db.execute("COMMIT")
+
+    def outbox_retry(self, entry, error, delay):
+        self._db().execute(
+            "UPDATE odoo_outbox SET attempts = attempts + 1, next_attempt = ?,"
+            " last_error = ? WHERE id = ?",
+            (time.time() + delay, str(error), entry.id),
+        )
+
+    def outbox_stats(self):
+        pending, oldest, failing = (
+            self._db()
+            .execute(
+                "SELECT COUNT(*), MIN(created), COUNT(last_error) FROM odoo_outbox"
+            )
+            .fetchone()
+        )
+        return {
+            "pending": pending,
+            "failing": failing,
+            "lag_seconds": time.time() - oldest if oldest is not None else 0.0,
+        }
@@ -0,0 +1,170 @@
+import logging
+import threading
+import time
+import xmlrpc.client
+
+from metrics import Counter
+from odoo_client import _CONNECTION_ERRORS, OdooAuthError, OdooUnavailable
+from tracing import tracer
+
+LEADS_SYNCED = Counter("contactform_leads_synced_total", "Leads created in Odoo")
+LEAD_SYNC_RETRIES = Counter(
+    "contactform_lead_sync_retries_total",
+    "Attempts to create a lead in Odoo that failed and have to be retried",
+)
+
+
+class LeadSync:
+    """Background worker that creates the leads waiting in the outbox in Odoo.
+
+    Due leads are sent in batches with a single multi-record create call.
+    If a batch fails for any other reason than Odoo being unreachable, its
+    leads are retried one by one so a single bad record doesn't hold back
+    the others; leads that can't be created are retried with exponential
+    backoff.
+
+    Leads submitted before the campaign, source and tag IDs could be looked
+    up in Odoo wait until they are known and get the current ones.
+    """
+
+    def __init__(
+        self,
+        odoo_client,
+        lead_store,
+        config,
+        batch_size=50,
+        backoff_base=2,
+        backoff_max=300,
+    ):
+        self.odoo_client = odoo_client
+        self.lead_store = lead_store
+        self.config = config
+        self.batch_size = batch_size
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._pending = threading.Event()
+        self._lock = threading.Lock()
+        # Traces of the submissions whose leads are in the outbox
+        self._traces = {}
+        self._stats = {
+            "synced": 0,
+            "batches": 0,
+            "retries": 0,
+            "last_sync": None,
+            "sync_seconds_total": 0.0,
+        }
+
+    def start(self):
+        pending = self.lead_store.outbox_stats()["pending"]
+        if pending:
+            logging.info(f"{pending} lead(s) still have to be created in Odoo")
+        threading.Thread(target=self._sync_loop, name="odoo-sync", daemon=True).start()
+
+    def notify(self, lead_id=None, trace=None):
+        """Wake up the worker after a lead was put in the outbox or the IDs changed.
+
+        The trace of the submission of the lead is continued when it is synced.
+        """
+        if trace is not None:
+            with self._lock:
+                self._traces[lead_id] = trace
+        self._pending.set()
+
+    def _values(self, entry):
+        values = dict(entry.values)
+        values.setdefault("campaign_id", self.config.CAMPAIGN_ID)
+        values.setdefault("source_id", self.config.SOURCE_ID)
+        values.setdefault("tag_ids", [(4, self.config.TAG_ID)])
+        return values
+
+    def _sync_loop(self):
+        failures = 0
+        while True:
+            try:
+                self._sync_due()
+                failures = 0
+            except Exception:
+                # E.g. a locked database, the worker must outlive it
+                delay = min(self.backoff_base * 2**failures, self.backoff_max)
+                failures += 1
+                logging.exception(f"Lead sync failed, trying again in {delay}s")
+                time.sleep(delay)
+
+    def _sync_due(self):
+        if not self.config.ids_resolved():
+            # Nothing can be created before the IDs are known
+            self._pending.wait()
+            self._pending.clear()
+            return
+        entries = self.lead_store.outbox_due(self.batch_size)
+        if not entries:
+            next_attempt = self.lead_store.outbox_next_attempt()
+            wait = None if next_attempt is None else next_attempt - time.time()
+            # Sleep until a new lead comes in or the backoff is over
+            self._pending.wait(wait)
+            self._pending.clear()
+            return
+        self._sync(entries)
+
+    def _sync(self, entries):
+        started = time.monotonic()
+        with self._lock:
+            traces = [self._traces.get(entry.lead_id) for entry in entries]
+        # A batch belongs to several submissions, it is linked to their traces
+        parent = traces[0] if len(entries) == 1 else None
+        try:
+            with tracer.span(
+                "sync leads",
+                parent=parent,
+                links=() if parent else traces,
+                attributes={"leads": len(entries)},
+            ):
+                lead_ids = self.odoo_client.create_many(
+                    "crm.lead", [self._values(entry) for entry in entries]
+                )
+        except (*_CONNECTION_ERRORS, OdooUnavailable, OdooAuthError) as e:
+            # Odoo unreachable, the whole batch has to wait
+            for entry in entries:
+                self._retry(entry, e)
+            return
+        except Exception as e:
+            # A Fault from Odoo or e.g. a value that can't be marshalled,
+            # either way it might be a single bad record
+            if len(entries) == 1:
+                self._retry(entries[0], e)
+            else:
+                reason = e.faultString if isinstance(e, xmlrpc.client.Fault) else e
+                logging.warning(
+                    f"Couldn't create a batch of {len(entries)} leads in Odoo,"
+                    f" retrying one by one: {reason}"
+                )
+                for entry in entries:
+                    self._sync([entry])
+            return
+
+        self.lead_store.outbox_done(entries)
+        for entry, lead_id in zip(entries, lead_ids):
+            logging.debug(f"Created Lead ID {lead_id} for {entry}")
+        LEADS_SYNCED.inc(amount=len(entries))
+        with self._lock:
+            for entry in entries:
+                self._traces.pop(entry.lead_id, None)
+            self._stats["synced"] += len(entries)
+            self._stats["batches"] += 1
+            self._stats["last_sync"] = time.time()
+            self._stats["sync_seconds_total"] += time.monotonic() - started
+
+    def _retry(self, entry, error):
+        delay = min(self.backoff_base * 2**entry.attempts, self.backoff_max)
+        self.lead_store.outbox_retry(entry, error, delay)
+        logging.error(f"Couldn't create {entry} in Odoo, retrying in {delay}s: {error}")
+        LEAD_SYNC_RETRIES.inc()
+        with self._lock:
+            self._stats["retries"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(self.lead_store.outbox_stats())
+        stats["odoo_circuit"] = self.odoo_client.circuit.state
+        return stats
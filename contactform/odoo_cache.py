@@ -0,0 +1,137 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from odoo_client import load_countries
+from tracing import tracer
+
+# How long to wait before trying again when Odoo couldn't be reached
+_RETRY_INTERVAL = 30
+
+
+class OdooCache:
+    """Local copy of the Odoo data the form depends on.
+
+    Keeps the campaign, source and tag IDs, the country list and the uid of
+    the Odoo user in a JSON file, so the app starts right away from the last
+    known state even if Odoo is unreachable. A background thread refreshes the data once it is
+    older than the TTL, or as soon as Odoo is reachable again.
+    """
+
+    def __init__(self, odoo_client, config, path, ttl=3600, on_refresh=None):
+        self.odoo_client = odoo_client
+        self.config = config
+        self.path = path
+        self.ttl = ttl
+        self.on_refresh = on_refresh
+        self._lock = threading.Lock()
+        self._retry_at = 0
+        self._data = {"updated": 0, "ids": {}, "countries": []}
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                self._data = json.load(file)
+            logging.info(f"Loaded Odoo data from {path}")
+        self._apply_ids()
+        self._countries = self._choices(self._data["countries"])
+        # Saves authenticating again, a stale uid is replaced on the first call
+        if self._data.get("login") == odoo_client.login:
+            odoo_client.uid = self._data.get("uid")
+
+    def _lookups(self):
+        return [
+            ("utm.campaign", self.config.CAMPAIGN_NAME, "CAMPAIGN_ID"),
+            ("utm.source", self.config.SOURCE_NAME, "SOURCE_ID"),
+            ("crm.tag", self.config.TAG_NAME, "TAG_ID"),
+        ]
+
+    def _apply_ids(self):
+        for model, name, attribute in self._lookups():
+            record_id = self._data["ids"].get(model, {}).get(name)
+            if record_id is not None:
+                setattr(self.config, attribute, record_id)
+
+    def _choices(self, countries):
+        # Immutable, so the rendered select can be cached for exactly this list
+        return tuple(tuple(country) for country in countries) or (("", "---"),)
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self._data, file, indent=4)
+        os.replace(tmp_path, self.path)
+
+    def start(self):
+        threading.Thread(
+            target=self._refresh_loop, name="odoo-cache", daemon=True
+        ).start()
+
+    @property
+    def version(self):
+        """Changes whenever the data was refreshed."""
+        return self._data["updated"]
+
+    def countries(self):
+        """Country choices for the form, a placeholder until Odoo was reached once."""
+        return self._countries
+
+    def remember(self, model, name, record_id):
+        """Keep an ID that was looked up elsewhere, e.g. after a config change."""
+        with self._lock:
+            self._data["ids"].setdefault(model, {})[name] = record_id
+            self._save()
+
+    def refresh(self):
+        # The countries are fetched while the IDs are looked up
+        countries = self.odoo_client.submit(load_countries, self.odoo_client)
+        self.config.lookup_ids(self.odoo_client)
+        countries = countries.result()
+        ids = {}
+        for model, name, attribute in self._lookups():
+            ids[model] = {name: getattr(self.config, attribute)}
+        with self._lock:
+            # The countries first, whatever has seen the new version sees them too
+            self._countries = self._choices(countries)
+            self._data = {
+                "updated": time.time(),
+                "ids": ids,
+                "countries": countries,
+                "login": self.odoo_client.login,
+                "uid": self.odoo_client.uid,
+            }
+            self._save()
+        logging.info("Refreshed Odoo data")
+        if self.on_refresh:
+            self.on_refresh()
+
+    def _next_refresh(self):
+        """Return the seconds until the data should be refreshed."""
+        with self._lock:
+            complete = self._data["countries"] and all(
+                name in self._data["ids"].get(model, {})
+                for model, name, _ in self._lookups()
+            )
+            due = self._data["updated"] + self.ttl if complete else 0
+        return max(due, self._retry_at) - time.time()
+
+    def _refresh_loop(self):
+        while True:
+            wait = self._next_refresh()
+            if wait > 0:
+                time.sleep(wait)
+                continue
+            try:
+                with tracer.span("refresh odoo cache"):
+                    self.refresh()
+                self._retry_at = 0
+            except ValueError as e:
+                # A campaign, source or tag doesn't exist (yet) in Odoo
+                logging.error(e)
+                self._retry_at = time.time() + _RETRY_INTERVAL
+            except Exception as e:
+                logging.warning(
+                    f"Couldn't reach Odoo, using cached data for now"
+                    f" (retrying in {_RETRY_INTERVAL}s): {e}"
+                )
+                self._retry_at = time.time() + _RETRY_INTERVAL
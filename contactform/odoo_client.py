@@ -1,37 +1,343 @@
+import asyncio
+import contextvars
+import http.client
+import queue
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
 import xmlrpc.client
 import logging
 
+import aiohttp
+
+from metrics import Counter, Histogram
+from tracing import CLIENT, tracer
+
+
+class OdooUnavailable(Exception):
+    pass
+
+
+class OdooAuthError(Exception):
+    pass
+
+
+# Fault code Odoo uses for odoo.exceptions.AccessDenied
+_ACCESS_DENIED = 3
+
+# Errors that mean Odoo couldn't be reached, as opposed to a Fault it returned
+_CONNECTION_ERRORS = (
+    OSError,
+    EOFError,
+    http.client.HTTPException,
+    xmlrpc.client.ProtocolError,
+)
+
+
+ODOO_CALL_SECONDS = Histogram(
+    "contactform_odoo_call_seconds", "Duration of calls to Odoo", ["method"]
+)
+ODOO_CALL_FAILURES = Counter(
+    "contactform_odoo_call_failures_total",
+    "Calls to Odoo that failed, by whether Odoo returned a fault, couldn't be"
+    " reached or the circuit breaker was open",
+    ["method", "error"],
+)
+
+
+def _span_attributes(method):
+    return {"rpc.system": "xmlrpc", "rpc.service": "odoo", "rpc.method": method}
+
+
+def _is_auth_fault(fault):
+    return fault.faultCode == _ACCESS_DENIED or "AccessDenied" in fault.faultString
+
+
+class CircuitBreaker:
+    """Stops calling Odoo while it is down.
+
+    After failure_threshold consecutive connection failures the circuit opens
+    and calls fail right away with OdooUnavailable. Once reset_timeout
+    seconds have passed, a single trial call is let through: if it succeeds
+    the circuit closes again, otherwise it stays open for another round.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return "open"
+            return "half-open"
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            now = time.monotonic()
+            if now - self._opened_at < self.reset_timeout:
+                raise OdooUnavailable(
+                    f"Odoo is unavailable, not calling it for up to {self.reset_timeout}s"
+                )
+            # Let this call through as the trial, everyone else keeps waiting
+            self._opened_at = now
+
+    def success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logging.info("Odoo is reachable again")
+            self._failures = 0
+            self._opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._opened_at is not None:
+                self._opened_at = time.monotonic()
+            elif self._failures >= self.failure_threshold:
+                logging.warning(
+                    f"Odoo failed {self._failures} times in a row,"
+                    f" pausing calls for {self.reset_timeout}s"
+                )
+                self._opened_at = time.monotonic()
+
+
+def _names_by_model(lookups):
+    names = {}
+    for model, name in lookups:
+        names.setdefault(model, []).append(name)
+    return names
+
+
+def _names_search(model, names):
+    return (
+        model,
+        "search_read",
+        [[("name", "in", names)]],
+        {"fields": ["id", "name"], "order": "id"},
+    )
+
+
+def _ids_by_name(model, names, records):
+    ids = {}
+    for record in records:
+        # Same as find_id_by_name: the oldest record wins
+        ids.setdefault(record["name"], record["id"])
+    for name in names:
+        if name not in ids:
+            raise ValueError(f"No record found for name '{name}' in model '{model}'.")
+    return ids
+
+
+def _lookup_results(lookups, names, results):
+    ids = {
+        model: _ids_by_name(model, model_names, records)
+        for (model, model_names), records in zip(names.items(), results)
+    }
+    return [ids[model][name] for model, name in lookups]
+
+
+class PooledTransport(xmlrpc.client.Transport):
+    """Thread-safe XML-RPC transport with a pool of keep-alive connections.
+
+    The stock transport keeps a single connection that can't be used by two
+    threads at once. Here every call checks out an idle connection (or opens
+    a new one) and returns it to the pool afterwards, with at most pool_size
+    calls in flight. When a call fails because the server closed its
+    keep-alive connection, the other idle connections have most likely timed
+    out as well: they are all closed and the call is retried once on a new
+    connection.
+    """
+
+    def __init__(self, pool_size=4, timeout=30, secure=False):
+        super().__init__()
+        self.timeout = timeout
+        self.secure = secure
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._local = threading.local()
+
+    def request(self, host, handler, request_body, verbose=False):
+        with self._slots:
+            try:
+                try:
+                    return self.single_request(host, handler, request_body, verbose)
+                except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+                    # Also raised when the server closed it without a response
+                    self._close_idle()
+                    return self.single_request(host, handler, request_body, verbose)
+            finally:
+                connection = getattr(self._local, "connection", None)
+                self._local.connection = None
+                if connection is not None:
+                    self._idle.put(connection)
+
+    def make_connection(self, host):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                chost, self._extra_headers, x509 = self.get_host_info(host)
+                if self.secure:
+                    connection = http.client.HTTPSConnection(
+                        chost, timeout=self.timeout
+                    )
+                else:
+                    connection = http.client.HTTPConnection(chost, timeout=self.timeout)
+            self._local.connection = connection
+        return connection
+
+    def _close_idle(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def close(self):
+        # Called by the base class after a failed call, the connection is dropped
+        connection = getattr(self._local, "connection", None)
+        self._local.connection = None
+        if connection is not None:
+            connection.close()
+
 
 class OdooClient:
-    def __init__(self, url, db, username, password):
+    def __init__(
+        self,
+        url,
+        db,
+        username,
+        password,
+        pool_size=4,
+        timeout=30,
+        circuit=None,
+    ):
         self.url = url
         self.db = db
         self.username = username
         self.password = password
-        self.common = xmlrpc.client.ServerProxy(f"{url}/xmlrpc/2/common")
-        self.models = xmlrpc.client.ServerProxy(f"{url}/xmlrpc/2/object")
-        self.uid = self.authenticate()
+        transport = PooledTransport(
+            pool_size=pool_size, timeout=timeout, secure=url.startswith("https:")
+        )
+        self.common = xmlrpc.client.ServerProxy(
+            f"{url}/xmlrpc/2/common", transport=transport
+        )
+        self.models = xmlrpc.client.ServerProxy(
+            f"{url}/xmlrpc/2/object", transport=transport
+        )
+        # Authenticated on the first call, so the app can start while Odoo is down,
+        # and again whenever Odoo rejects the session
+        self.uid = None
+        self._auth_lock = threading.Lock()
+        self.circuit = circuit or CircuitBreaker()
+        # Odoo has no system.multicall, independent calls run side by side instead
+        self._executor = ThreadPoolExecutor(
+            max_workers=pool_size, thread_name_prefix="odoo"
+        )
+
+    @property
+    def login(self):
+        """Identifies the account a cached uid belongs to."""
+        return f"{self.username}@{self.url}/{self.db}"
+
+    def _call(self, method, fn, *args):
+        try:
+            self.circuit.before_call()
+        except OdooUnavailable:
+            ODOO_CALL_FAILURES.inc(method, "circuit_open")
+            raise
+        started = time.monotonic()
+        try:
+            with tracer.span(
+                f"odoo {method}", attributes=_span_attributes(method), kind=CLIENT
+            ):
+                result = fn(*args)
+        except xmlrpc.client.Fault:
+            # Odoo answered, so it is reachable
+            self.circuit.success()
+            ODOO_CALL_FAILURES.inc(method, "fault")
+            raise
+        except _CONNECTION_ERRORS:
+            self.circuit.failure()
+            ODOO_CALL_FAILURES.inc(method, "unreachable")
+            raise
+        finally:
+            ODOO_CALL_SECONDS.observe(time.monotonic() - started, method)
+        self.circuit.success()
+        return result
 
     def authenticate(self):
         logging.info(f"Authenticating against {self.url} as {self.username}")
-        return self.common.authenticate(self.db, self.username, self.password, {})
-
-    def search_read(self, model, domain, fields, order="id"):
-        return self.models.execute_kw(
+        uid = self._call(
+            "authenticate",
+            self.common.authenticate,
             self.db,
-            self.uid,
+            self.username,
             self.password,
-            model,
-            "search_read",
-            [domain],
-            {"fields": fields, "order": order},
+            {},
         )
+        if not uid:
+            raise OdooAuthError(f"Odoo rejected the credentials of {self.username}")
+        return uid
 
-    def create(self, model, data):
-        return self.models.execute_kw(
-            self.db, self.uid, self.password, model, "create", [data]
+    def _uid(self):
+        with self._auth_lock:
+            if self.uid is None:
+                self.uid = self.authenticate()
+            return self.uid
+
+    def _forget_uid(self, uid):
+        with self._auth_lock:
+            if self.uid == uid:
+                self.uid = None
+
+    def execute_kw(self, model, method, args, kwargs=None):
+        uid = self.uid or self._uid()
+        params = (self.password, model, method, args, kwargs or {})
+        try:
+            return self._call(method, self.models.execute_kw, self.db, uid, *params)
+        except xmlrpc.client.Fault as e:
+            if not _is_auth_fault(e):
+                raise
+        logging.warning(f"Odoo rejected the session of {self.username}")
+        self._forget_uid(uid)
+        return self._call(method, self.models.execute_kw, self.db, self._uid(), *params)
+
+    def submit(self, fn, *args):
+        """Run fn(*args) in the background, e.g. a call that doesn't depend on
+        the ones made in the meantime. Returns a Future."""
+        # Within the span of the caller
+        context = contextvars.copy_context()
+        return self._executor.submit(context.run, fn, *args)
+
+    def execute_many(self, calls):
+        """Run several (model, method, args, kwargs) calls concurrently over the
+        connection pool and return their results in the same order."""
+        futures = [self.submit(self.execute_kw, *call) for call in calls]
+        return [future.result() for future in futures]
+
+    def search_read(self, model, domain, fields, order="id"):
+        return self.execute_kw(
+            model, "search_read", [domain], {"fields": fields, "order": order}
         )
 
+    def create(self, model, data):
+        return self.execute_kw(model, "create", [data])
+
+    def create_many(self, model, records):
+        """Create several records with a single call, returns their IDs."""
+        return self.execute_kw(model, "create", [records])
+
     def find_id_by_name(self, model, name):
         logging.debug(f"Searching for id of '{name}' in model '{model}'")
         records = self.search_read(model, [("name", "=", name)], ["id"])
@@ -40,6 +346,207 @@ class OdooClient:
         else:
             raise ValueError(f"No record found for name '{name}' in model '{model}'.")
 
+    def find_ids(self, lookups):
+        """Look up the IDs for a list of (model, name) pairs.
+
+        Names are grouped by model into one search_read each, and the models
+        are queried concurrently, so this takes a single round trip.
+        """
+        names = _names_by_model(lookups)
+        results = self.execute_many(
+            _names_search(model, model_names) for model, model_names in names.items()
+        )
+        return _lookup_results(lookups, names, results)
+
+
+class AsyncConnectionPool:
+    """XML-RPC posts to a single server over a pool of aiohttp connections.
+
+    Keeps idle keep-alive connections for reuse and allows at most pool_size
+    requests in flight. Every request, including connecting, times out after
+    timeout seconds. A request the server closed the connection on is retried
+    once on a new connection, as the other idle connections may have been
+    closed by the server just the same.
+    """
+
+    def __init__(self, url, pool_size=4, timeout=30):
+        self.url = url.rstrip("/")
+        self.pool_size = pool_size
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session = None
+        self._slots = asyncio.Semaphore(pool_size)
+
+    def _pooled(self):
+        # aiohttp sessions belong to the event loop they are created on
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=self.timeout,
+            )
+        return self._session
+
+    async def _post(self, session, path, body):
+        async with session.post(
+            f"{self.url}{path}", data=body, headers={"Content-Type": "text/xml"}
+        ) as response:
+            data = await response.read()
+            if response.status != 200:
+                raise xmlrpc.client.ProtocolError(
+                    f"{self.url}{path}", response.status, response.reason, {}
+                )
+            return data
+
+    async def post(self, path, body):
+        async with self._slots:
+            try:
+                return await self._post(self._pooled(), path, body)
+            except aiohttp.ClientConnectorError:
+                # Nothing was sent, the server can't be reached
+                raise
+            except (aiohttp.ServerDisconnectedError, aiohttp.ClientOSError):
+                async with aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(force_close=True),
+                    timeout=self.timeout,
+                ) as session:
+                    return await self._post(session, path, body)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class AsyncOdooClient:
+    """asyncio counterpart of OdooClient with the same methods as coroutines.
+
+    Many calls can run concurrently on one event loop, limited by the
+    pool_size of the underlying connection pool.
+    """
+
+    def __init__(
+        self,
+        url,
+        db,
+        username,
+        password,
+        pool_size=4,
+        timeout=30,
+        circuit=None,
+    ):
+        self.url = url
+        self.db = db
+        self.username = username
+        self.password = password
+        self.uid = None
+        self.circuit = circuit or CircuitBreaker()
+        self._pool = AsyncConnectionPool(url, pool_size=pool_size, timeout=timeout)
+        self._auth_lock = asyncio.Lock()
+
+    @property
+    def login(self):
+        """Identifies the account a cached uid belongs to."""
+        return f"{self.username}@{self.url}/{self.db}"
+
+    async def _call(self, label, service, method, *params):
+        body = xmlrpc.client.dumps(params, method).encode()
+        try:
+            self.circuit.before_call()
+        except OdooUnavailable:
+            ODOO_CALL_FAILURES.inc(label, "circuit_open")
+            raise
+        started = time.monotonic()
+        try:
+            with tracer.span(
+                f"odoo {label}", attributes=_span_attributes(label), kind=CLIENT
+            ):
+                data = await self._pool.post(f"/xmlrpc/2/{service}", body)
+        except (*_CONNECTION_ERRORS, aiohttp.ClientError):
+            self.circuit.failure()
+            ODOO_CALL_FAILURES.inc(label, "unreachable")
+            raise
+        finally:
+            ODOO_CALL_SECONDS.observe(time.monotonic() - started, label)
+        self.circuit.success()
+        try:
+            # Raises a Fault for error responses
+            return xmlrpc.client.loads(data)[0][0]
+        except xmlrpc.client.Fault:
+            ODOO_CALL_FAILURES.inc(label, "fault")
+            raise
+
+    async def authenticate(self):
+        logging.info(f"Authenticating against {self.url} as {self.username}")
+        uid = await self._call(
+            "authenticate",
+            "common",
+            "authenticate",
+            self.db,
+            self.username,
+            self.password,
+            {},
+        )
+        if not uid:
+            raise OdooAuthError(f"Odoo rejected the credentials of {self.username}")
+        return uid
+
+    async def _uid(self):
+        async with self._auth_lock:
+            if self.uid is None:
+                self.uid = await self.authenticate()
+            return self.uid
+
+    async def execute_kw(self, model, method, args, kwargs=None):
+        uid = self.uid or await self._uid()
+        params = (self.password, model, method, args, kwargs or {})
+        try:
+            return await self._call(
+                method, "object", "execute_kw", self.db, uid, *params
+            )
+        except xmlrpc.client.Fault as e:
+            if not _is_auth_fault(e):
+                raise
+        logging.warning(f"Odoo rejected the session of {self.username}")
+        if self.uid == uid:
+            self.uid = None
+        uid = await self._uid()
+        return await self._call(method, "object", "execute_kw", self.db, uid, *params)
+
+    async def execute_many(self, calls):
+        """Run several (model, method, args, kwargs) calls concurrently and
+        return their results in the same order."""
+        return await asyncio.gather(*(self.execute_kw(*call) for call in calls))
+
+    async def search_read(self, model, domain, fields, order="id"):
+        return await self.execute_kw(
+            model, "search_read", [domain], {"fields": fields, "order": order}
+        )
+
+    async def create(self, model, data):
+        return await self.execute_kw(model, "create", [data])
+
+    async def create_many(self, model, records):
+        """Create several records with a single call, returns their IDs."""
+        return await self.execute_kw(model, "create", [records])
+
+    async def find_id_by_name(self, model, name):
+        logging.debug(f"Searching for id of '{name}' in model '{model}'")
+        records = await self.search_read(model, [("name", "=", name)], ["id"])
+        if records:
+            return records[0]["id"]
+        else:
+            raise ValueError(f"No record found for name '{name}' in model '{model}'.")
+
+    async def find_ids(self, lookups):
+        """Look up the IDs for a list of (model, name) pairs in one round trip."""
+        names = _names_by_model(lookups)
+        results = await self.execute_many(
+            _names_search(model, model_names) for model, model_names in names.items()
+        )
+        return _lookup_results(lookups, names, results)
+
+    async def close(self):
+        await self._pool.close()
+
 
 def load_countries(odoo_client):
     odoo_countries = odoo_client.search_read(
@@ -0,0 +1,345 @@
+import collections
+import logging
+import queue
+import threading
+import time
+
+from metrics import Counter, Histogram
+from printer import send_label
+from printer_pool import PrinterPool
+from tracing import current, tracer
+
+LABEL_RENDER_SECONDS = Histogram(
+    "contactform_label_render_seconds", "Time to render a label", ["kind"]
+)
+PRINTER_SEND_SECONDS = Histogram(
+    "contactform_printer_send_seconds", "Time to send a label to a printer", ["printer"]
+)
+LABEL_JOB_SECONDS = Histogram(
+    "contactform_label_job_seconds", "Time from submitting a label until it was printed"
+)
+PRINT_FAILURES = Counter(
+    "contactform_print_failures_total",
+    "Labels that couldn't be rendered, queued or sent to the printer",
+    ["stage"],
+)
+
+# Seconds a print thread pauses after an unexpected error, e.g. a locked spool
+_ERROR_DELAY = 1
+
+
+class PrintQueueFull(Exception):
+    pass
+
+
+class PrintJob:
+    def __init__(self, kind, name, render, args):
+        self.kind = kind
+        self.name = name
+        self.render = render
+        self.args = args
+        self.submitted_at = time.monotonic()
+        # The label is rendered and printed as part of the submission's trace
+        self.trace = current()
+
+    def __str__(self):
+        return f"{self.kind} label for {self.name}"
+
+
+class PrintQueue:
+    """Bounded label job queue.
+
+    A configurable number of render workers turn submitted jobs into raster
+    instructions and persist them in the print spool, so nothing rendered is
+    lost on a restart. A dispatcher hands the spooled labels in order to the
+    printers of the pool, each with a sender thread of its own, so there is
+    never more than one TCP session to a printer at a time. The labels of a
+    visitor stay together on one printer as long as it has room for them,
+    labels a printer failed to take, and those waiting for it, go to another
+    one right away.
+
+    Reprints and bulk prints wait in a separate batch, from which a feeder
+    thread passes batch_rate labels per minute on to the render workers,
+    and only while fewer than batch_max_pending labels are in line, so the
+    labels of visitors at the booth never queue up behind a whole batch.
+    """
+
+    def __init__(
+        self,
+        printer_config,
+        spool,
+        render_workers=1,
+        max_size=20,
+        batch_rate=20,
+        batch_max_pending=2,
+        printers=None,
+    ):
+        self.printer_config = printer_config
+        self.spool = spool
+        self.printers = printers or PrinterPool(
+            [printer_config.printer.printer.removeprefix("tcp://")]
+        )
+        self.render_workers = render_workers
+        self.max_size = max_size
+        self.batch_rate = batch_rate
+        self.batch_max_pending = batch_max_pending
+        self._render_queue = queue.Queue()
+        # Set when a label was spooled or a printer is free again
+        self._spooled = threading.Event()
+        self._outboxes = {printer: queue.Queue() for printer in self.printers.printers}
+        # IDs of the spooled labels handed to a printer
+        self._claimed = set()
+        # Name and printer of the last dispatched label
+        self._last_dispatched = (None, None)
+        self._batch = collections.deque()
+        self._batched = threading.Event()
+        self._lock = threading.Lock()
+        self._rendering = 0
+        # Submission times and traces of spooled jobs, for the end-to-end latency
+        self._submitted_at = {}
+        self._traces = {}
+        self._stats = {
+            "submitted": 0,
+            "printed": 0,
+            "failed": 0,
+            "rejected": 0,
+            "batched": 0,
+            "send_retries": 0,
+            "render_seconds_total": 0.0,
+            "print_seconds_total": 0.0,
+            "job_seconds_total": 0.0,
+            "job_seconds_max": 0.0,
+        }
+
+    def start(self):
+        for i in range(self.render_workers):
+            threading.Thread(
+                target=self._render_loop, name=f"render-{i}", daemon=True
+            ).start()
+        self.printers.start()
+        for i, (printer, jobs) in enumerate(self._outboxes.items()):
+            threading.Thread(
+                target=self._send_loop,
+                args=(printer, jobs),
+                name=f"printer-{i}",
+                daemon=True,
+            ).start()
+        threading.Thread(
+            target=self._dispatch_loop, name="printer-dispatch", daemon=True
+        ).start()
+        threading.Thread(
+            target=self._batch_loop, name="print-batch", daemon=True
+        ).start()
+
+    def submit(self, kind, name, render, *args):
+        """Queue a label and return its position in line (1 = next up)."""
+        with self._lock:
+            if self._rendering >= self.max_size:
+                self._stats["rejected"] += 1
+                PRINT_FAILURES.inc("queue")
+                raise PrintQueueFull(f"Print queue is full ({self.max_size} jobs)")
+            self._rendering += 1
+            self._stats["submitted"] += 1
+            position = self._rendering
+        self._render_queue.put(PrintJob(kind, name, render, args))
+        return position + self.spool.count()
+
+    def submit_batch(self, jobs, first=False):
+        """Queue (kind, name, render, *args) label jobs to be printed at the batch rate.
+
+        With first, the jobs go ahead of the labels already in the batch, e.g.
+        a reprint for someone waiting at the booth. Returns the number of
+        labels in the batch.
+        """
+        jobs = [
+            PrintJob(kind, name, render, args) for kind, name, render, *args in jobs
+        ]
+        with self._lock:
+            if first:
+                self._batch.extendleft(reversed(jobs))
+            else:
+                self._batch.extend(jobs)
+            self._stats["batched"] += len(jobs)
+            pending = len(self._batch)
+        self._batched.set()
+        return pending
+
+    def _batch_loop(self):
+        while True:
+            try:
+                self._feed_batch()
+            except Exception:
+                logging.exception("Feeding the print batch failed")
+                time.sleep(_ERROR_DELAY)
+
+    def _feed_batch(self):
+        interval = 60 / max(self.batch_rate, 1)
+        self._batched.wait()
+        with self._lock:
+            if not self._batch:
+                self._batched.clear()
+                return
+            in_line = self._rendering
+        if in_line + self.spool.count() >= self.batch_max_pending:
+            # Let the printer catch up, visitors' labels go first
+            time.sleep(min(interval, 1))
+            return
+        with self._lock:
+            job = self._batch.popleft()
+            self._rendering += 1
+            self._stats["submitted"] += 1
+        # The time spent in the batch doesn't count as waiting for the printer
+        job.submitted_at = time.monotonic()
+        self._render_queue.put(job)
+        time.sleep(interval)
+
+    def _render_loop(self):
+        while True:
+            job = self._render_queue.get()
+            started = time.monotonic()
+            try:
+                with (
+                    LABEL_RENDER_SECONDS.time(job.kind),
+                    tracer.span(
+                        "render label",
+                        parent=job.trace,
+                        attributes={"label.kind": job.kind},
+                    ),
+                ):
+                    data = job.render(*job.args)
+                job_id = self.spool.add(job.kind, job.name, data)
+            except Exception as e:
+                logging.error(f"Rendering of {job} failed: {e}")
+                PRINT_FAILURES.inc("render")
+                with self._lock:
+                    self._rendering -= 1
+                    self._stats["failed"] += 1
+                continue
+            with self._lock:
+                self._rendering -= 1
+                self._stats["render_seconds_total"] += time.monotonic() - started
+                self._submitted_at[job_id] = job.submitted_at
+                self._traces[job_id] = job.trace
+            self._spooled.set()
+
+    def _dispatch_loop(self):
+        while True:
+            try:
+                self._dispatch_next()
+            except Exception:
+                logging.exception("Dispatching labels to the printers failed")
+                time.sleep(_ERROR_DELAY)
+
+    def _dispatch_next(self):
+        with self._lock:
+            claimed = set(self._claimed)
+        job = self.spool.next_job(exclude=claimed)
+        wait = None if job is None else job.next_attempt - time.time()
+        printer = None
+        if wait is not None and wait <= 0:
+            last_name, last_printer = self._last_dispatched
+            printer = self.printers.acquire(
+                prefer=last_printer if job.name == last_name else None
+            )
+        if printer is None:
+            # Sleep until new work is spooled, a printer is free or the
+            # backoff is over
+            self._spooled.wait(wait if wait is not None and wait > 0 else None)
+            self._spooled.clear()
+            return
+
+        with self._lock:
+            self._claimed.add(job.id)
+        self._last_dispatched = (job.name, printer)
+        self._outboxes[printer].put(job)
+
+    def _send_loop(self, printer, jobs):
+        while True:
+            job = jobs.get()
+            try:
+                self._send(printer, job)
+            except Exception:
+                # The label stays in the spool and is dispatched again
+                logging.exception(f"Printing of {job} on {printer} failed")
+                time.sleep(_ERROR_DELAY)
+            finally:
+                with self._lock:
+                    self._claimed.discard(job.id)
+                self._spooled.set()
+
+    def _send(self, printer, job):
+        logging.info(f"Printing {job} on {printer}")
+        started = time.monotonic()
+        error = None
+        try:
+            with tracer.span(
+                "print label",
+                parent=self._traces.get(job.id),
+                attributes={
+                    "label.kind": job.kind,
+                    "print.attempt": job.attempts + 1,
+                    "printer.address": printer.address,
+                },
+            ):
+                send_label(
+                    job.data,
+                    self.printer_config,
+                    printer.target,
+                    connect_timeout=self.printers.probe_timeout,
+                )
+        except Exception as e:
+            error = e
+        # The printer is returned first, so nothing below can leave it assigned
+        failover = self.printers.release(printer, error)
+        if error is not None:
+            PRINT_FAILURES.inc("send")
+            if failover:
+                logging.error(
+                    f"Printing of {job} on {printer} failed, handing it to another printer: {error}"
+                )
+            else:
+                delay = self.spool.retry_later(job, error)
+                logging.error(
+                    f"Printing of {job} failed, retrying in {delay}s: {error}"
+                )
+            with self._lock:
+                self._stats["send_retries"] += 1
+            self._return_waiting(printer)
+            return
+        self.spool.done(job)
+
+        finished = time.monotonic()
+        PRINTER_SEND_SECONDS.observe(finished - started, printer.address)
+        with self._lock:
+            self._stats["printed"] += 1
+            self._stats["print_seconds_total"] += finished - started
+            submitted_at = self._submitted_at.pop(job.id, None)
+            self._traces.pop(job.id, None)
+            if submitted_at is not None:
+                elapsed = finished - submitted_at
+                LABEL_JOB_SECONDS.observe(elapsed)
+                self._stats["job_seconds_total"] += elapsed
+                self._stats["job_seconds_max"] = max(
+                    self._stats["job_seconds_max"], elapsed
+                )
+
+    def _return_waiting(self, printer):
+        """Hand the labels waiting for a failed printer back to the dispatcher."""
+        jobs = self._outboxes[printer]
+        while True:
+            try:
+                job = jobs.get_nowait()
+            except queue.Empty:
+                return
+            self.printers.cancel(printer)
+            with self._lock:
+                self._claimed.discard(job.id)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["rendering"] = self._rendering
+            stats["batch"] = len(self._batch)
+        stats["spooled"] = self.spool.count()
+        stats["printers"] = self.printers.stats()
+        return stats
@@ -0,0 +1,111 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+class SpooledJob:
+    def __init__(self, id, kind, name, data, attempts, next_attempt):
+        self.id = id
+        self.kind = kind
+        self.name = name
+        self.data = data
+        self.attempts = attempts
+        self.next_attempt = next_attempt
+
+    def __str__(self):
+        return f"{self.kind} label for {self.name}"
+
+
+class PrintSpool:
+    """Crash-safe store for rendered labels that haven't been printed yet.
+
+    Every rendered label is committed to SQLite before it is sent, and only
+    removed once the printer accepted it. Failed sends are retried with
+    exponential backoff; whatever is left over is replayed on startup.
+    """
+
+    def __init__(self, path, backoff_base=2, backoff_max=300):
+        self.path = path
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._lock = threading.Lock()
+        self._pid = None
+        db = self._connect()
+        db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                name TEXT NOT NULL,
+                data BLOB NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL,
+                created REAL NOT NULL,
+                last_error TEXT
+            )
+            """
+        )
+        # Whatever survived a restart is due right away
+        db.execute("UPDATE jobs SET next_attempt = ?", (time.time(),))
+        leftover = db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+        db.close()
+        if leftover:
+            logging.info(f"Replaying {leftover} spooled label(s) from {path}")
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=FULL")
+        return db
+
+    @property
+    def _db(self):
+        # A connection must not be used across a fork, e.g. of a preloaded app
+        if self._pid != os.getpid():
+            self._connection = self._connect()
+            self._pid = os.getpid()
+        return self._connection
+
+    def add(self, kind, name, data):
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO jobs (kind, name, data, next_attempt, created)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (kind, name, data, now, now),
+            )
+        return cursor.lastrowid
+
+    def next_job(self, exclude=()):
+        """Return the oldest unprinted label apart from those in exclude, e.g. being sent.
+
+        Labels are handed out strictly in order.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, kind, name, data, attempts, next_attempt FROM jobs"
+                f" WHERE id NOT IN ({', '.join('?' * len(exclude))})"
+                " ORDER BY id LIMIT 1",
+                tuple(exclude),
+            ).fetchone()
+        return SpooledJob(*row) if row else None
+
+    def done(self, job):
+        with self._lock:
+            self._db.execute("DELETE FROM jobs WHERE id = ?", (job.id,))
+
+    def retry_later(self, job, error):
+        delay = min(self.backoff_base * 2**job.attempts, self.backoff_max)
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET attempts = attempts + 1, next_attempt = ?,"
+                " last_error = ? WHERE id = ?",
+                (time.time() + delay, str(error), job.id),
+            )
+        return delay
+
+    def count(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
@@ -0,0 +1,108 @@
+import socket
+
+from brother_ql import BrotherQLRaster, BrotherQLUnsupportedCmd, create_label
+from brother_ql.labels import ALL_LABELS, FormFactor
+from brother_ql.models import ALL_MODELS
+from PIL import Image, ImageChops
+
+# Percentage of darkness from which a pixel is printed, as brother_ql counts it
+THRESHOLD = 70
+
+# Seconds to wait for a printer to accept the connection, one that drops the
+# packets would otherwise block its sender until the OS gives up
+CONNECT_TIMEOUT = 2
+# Seconds sending a label may stall, as with brother_ql's network backend
+SEND_TIMEOUT = 10
+
+_LABELS = {label.identifier: label for label in ALL_LABELS}
+_MODELS = {model.identifier: model for model in ALL_MODELS}
+
+
+def _white_from(threshold):
+    # brother_ql inverts the greyscale image and prints everything from
+    # (100 - threshold)% of 255 on, so lighter pixels than this stay white.
+    return 255 - min(255, max(0, int((100.0 - threshold) / 100.0 * 255)))
+
+
+_BITMAP_LEVELS = [0 if value <= _white_from(THRESHOLD) else 255 for value in range(256)]
+
+
+def to_bitmap(image):
+    """Threshold a label image into the 1-bit image the printer prints."""
+    if image.mode == "1":
+        return image
+    if image.mode != "L":
+        image = image.convert("L")
+    return image.point(_BITMAP_LEVELS, "1")
+
+
+def _optional(command, *args):
+    try:
+        command(*args)
+    except BrotherQLUnsupportedCmd:
+        pass
+
+
+def rasterize(image, printer_config, label_size="54"):
+    """Convert an in-memory label image into raster instructions for the printer.
+
+    1-bit images exactly as wide as the printable area of an endless label,
+    as the label renderers produce them, go straight into the raster data
+    with the same commands brother_ql would send. Anything else is resized
+    and thresholded by brother_ql first.
+    """
+    qlr = BrotherQLRaster(printer_config.printer.model)
+    label = _LABELS[label_size]
+    if (
+        image.mode != "1"
+        or image.width != label.dots_printable[0]
+        or label.form_factor != FormFactor.ENDLESS
+    ):
+        create_label(qlr, image, label_size, threshold=THRESHOLD, cut=True, rotate=0)
+        return qlr.data
+
+    # The printer takes a full print head row with 1 for every dot to print,
+    # the printable area is aligned to the right margin.
+    right_margin = label.offset_r + _MODELS[qlr.model].additional_offset_r
+    bitmap = Image.new("1", (qlr.get_pixel_width(), image.height), 0)
+    bitmap.paste(
+        ImageChops.invert(image), (bitmap.width - image.width - right_margin, 0)
+    )
+
+    _optional(qlr.add_switch_mode)
+    qlr.add_invalidate()
+    qlr.add_initialize()
+    _optional(qlr.add_switch_mode)
+    qlr.add_status_information()
+    qlr.mtype = 0x0A
+    qlr.mwidth = label.tape_size[0]
+    qlr.mlength = 0
+    qlr.pquality = 1
+    qlr.add_media_and_quality(bitmap.height)
+    _optional(qlr.add_autocut, True)
+    _optional(qlr.add_cut_every, 1)
+    qlr.dpi_600 = False
+    qlr.cut_at_end = True
+    qlr.two_color_printing = False
+    _optional(qlr.add_expanded_mode)
+    qlr.add_margins(label.feed_margin)
+    qlr.add_raster_data(bitmap)
+    qlr.add_print()
+    return qlr.data
+
+
+def send_label(data, printer_config, printer=None, connect_timeout=CONNECT_TIMEOUT):
+    """Send rendered raster instructions to the label printer, or the given one.
+
+    Talks to the printer like brother_ql's network backend, but gives up if
+    it doesn't accept the connection within connect_timeout seconds.
+    """
+    address = (printer or printer_config.printer.printer).removeprefix("tcp://")
+    host, _, port = address.partition(":")
+    with socket.create_connection(
+        (host, int(port) if port else 9100), timeout=connect_timeout
+    ) as connection:
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection.settimeout(SEND_TIMEOUT)
+        connection.sendall(data)
+        connection.shutdown(socket.SHUT_RDWR)
@@ -0,0 +1,176 @@
+import logging
+import socket
+import threading
+import time
+
+from metrics import Gauge
+
+PRINTER_UP = Gauge(
+    "contactform_printer_up",
+    "1 while the printer is reachable, 0 while labels fail over to the others",
+    ["printer"],
+)
+
+DISPATCH_STRATEGIES = ("least-busy", "round-robin")
+
+# Print port of the Brother QL printers
+_DEFAULT_PORT = 9100
+
+
+class Printer:
+    """One label printer of the pool and the labels handed to it."""
+
+    def __init__(self, address):
+        self.address = address
+        host, _, port = address.partition(":")
+        self.host = host
+        self.port = int(port) if port else _DEFAULT_PORT
+        self.healthy = True
+        self.assigned = 0
+        self.printed = 0
+        self.failed = 0
+        self.last_error = None
+        self.last_assigned = 0.0
+        PRINTER_UP.set(1, address)
+
+    @property
+    def target(self):
+        return f"tcp://{self.address}"
+
+    def __str__(self):
+        return f"printer {self.address}"
+
+
+class PrinterPool:
+    """Hands label jobs to the healthiest, least busy of several printers.
+
+    Every printer gets at most max_assigned labels at a time, one being sent
+    and the next one ready, so a slow or jammed printer never holds back
+    more than that. With the least-busy strategy, labels go to the printer
+    with the fewest labels assigned, with round-robin to the next printer in
+    turn that has room for one. A printer that failed to take a label is
+    left out until a TCP probe reaches it again; while no printer is
+    healthy, all of them are tried, so the spool's backoff paces retries.
+    """
+
+    def __init__(
+        self,
+        addresses,
+        strategy="least-busy",
+        max_assigned=2,
+        probe_interval=10,
+        probe_timeout=2,
+    ):
+        if not addresses:
+            raise ValueError("The printer pool needs at least one printer")
+        if strategy not in DISPATCH_STRATEGIES:
+            raise ValueError(f"Unknown printer dispatch strategy {strategy}")
+        self.printers = [Printer(address) for address in addresses]
+        self.strategy = strategy
+        self.max_assigned = max_assigned
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(
+            target=self._probe_loop, name="printer-probe", daemon=True
+        ).start()
+
+    def acquire(self, prefer=None):
+        """Assign a label to a printer, None if all of them are busy.
+
+        The preferred printer is taken if it is healthy and has room, e.g. to
+        print all labels of a visitor on the same printer.
+        """
+        with self._lock:
+            candidates = [p for p in self.printers if p.healthy] or self.printers
+            candidates = [p for p in candidates if p.assigned < self.max_assigned]
+            if not candidates:
+                return None
+            if prefer in candidates:
+                printer = prefer
+            elif self.strategy == "round-robin":
+                count = len(self.printers)
+                printer = min(
+                    candidates,
+                    key=lambda p: (self.printers.index(p) - self._next) % count,
+                )
+                self._next = (self.printers.index(printer) + 1) % count
+            else:
+                # The one idle for the longest time among the least busy
+                printer = min(candidates, key=lambda p: (p.assigned, p.last_assigned))
+            printer.assigned += 1
+            printer.last_assigned = time.monotonic()
+            return printer
+
+    def release(self, printer, error=None):
+        """Return a printer after sending a label, with the error if it failed.
+
+        Returns whether other printers are healthy to take over the label.
+        """
+        with self._lock:
+            printer.assigned -= 1
+            was_healthy = printer.healthy
+            printer.healthy = error is None
+            if error is None:
+                printer.printed += 1
+            else:
+                printer.failed += 1
+                printer.last_error = str(error)
+            failover = error is not None and any(p.healthy for p in self.printers)
+        PRINTER_UP.set(int(error is None), printer.address)
+        if error is not None and was_healthy:
+            logging.warning(f"Taking {printer} out of the pool: {error}")
+        elif error is None and not was_healthy:
+            logging.info(f"{printer} is back in the pool")
+        return failover
+
+    def cancel(self, printer):
+        """Return a printer without sending the label assigned to it."""
+        with self._lock:
+            printer.assigned -= 1
+
+    def _probe(self, printer):
+        try:
+            with socket.create_connection(
+                (printer.host, printer.port), timeout=self.probe_timeout
+            ):
+                return None
+        except OSError as e:
+            return e
+
+    def _probe_loop(self):
+        while True:
+            time.sleep(self.probe_interval)
+            for printer in self.printers:
+                # A printer in use shows its health with the labels it takes,
+                # and it might not accept a second connection meanwhile
+                if printer.assigned:
+                    continue
+                error = self._probe(printer)
+                with self._lock:
+                    changed = printer.healthy != (error is None)
+                    printer.healthy = error is None
+                    if error is not None:
+                        printer.last_error = str(error)
+                PRINTER_UP.set(int(error is None), printer.address)
+                if changed and error is None:
+                    logging.info(f"{printer} is reachable again")
+                elif changed:
+                    logging.warning(f"{printer} is unreachable: {error}")
+
+    def stats(self):
+        with self._lock:
+            return [
+                {
+                    "printer": printer.address,
+                    "healthy": printer.healthy,
+                    "assigned": printer.assigned,
+                    "printed": printer.printed,
+                    "failed": printer.failed,
+                    "last_error": printer.last_error,
+                }
+                for printer in self.printers
+            ]
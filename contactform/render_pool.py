@@ -0,0 +1,283 @@
+import atexit
+import base64
+import json
+import logging
+import mimetypes
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.request
+
+import websocket
+from html2image.browsers.search_utils import find_chrome
+
+from tracing import tracer
+
+
+class RenderError(Exception):
+    pass
+
+
+_BROWSER_FLAGS = [
+    "--headless=new",
+    "--remote-debugging-port=0",
+    "--remote-allow-origins=*",
+    "--no-first-run",
+    "--no-default-browser-check",
+    "--disable-gpu",
+    "--disable-extensions",
+    "--hide-scrollbars",
+    "--default-background-color=FFFFFF",
+]
+
+# Resolves once all <img> elements and web fonts of the document are ready,
+# so the screenshot never catches a half-painted label.
+_WAIT_FOR_PAINT = """
+Promise.all([
+    document.fonts.ready,
+    ...Array.from(document.images, (img) => img.decode().catch(() => null)),
+])
+"""
+
+
+def data_uri(path):
+    """Inline a file (e.g. a logo) so it can be referenced from label HTML."""
+    mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    with open(path, "rb") as f:
+        encoded = base64.b64encode(f.read()).decode("ascii")
+    return f"data:{mime_type};base64,{encoded}"
+
+
+class BrowserWorker:
+    """A single long-lived headless Chromium driven over the DevTools protocol."""
+
+    def __init__(self, executable, startup_timeout=20, call_timeout=30):
+        self.executable = executable
+        self.startup_timeout = startup_timeout
+        self.call_timeout = call_timeout
+        self.renders = 0
+        self._proc = None
+        self._ws = None
+        self._user_data_dir = None
+        self._frame_id = None
+        self._message_id = 0
+
+    def start(self):
+        self._user_data_dir = tempfile.mkdtemp(prefix="contactform-chromium-")
+        command = [
+            self.executable,
+            *_BROWSER_FLAGS,
+            f"--user-data-dir={self._user_data_dir}",
+            "about:blank",
+        ]
+        logging.debug(f"Starting render browser: {' '.join(command)}")
+        self._proc = subprocess.Popen(
+            command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            port = self._wait_for_devtools_port()
+            self._ws = websocket.create_connection(
+                self._page_websocket_url(port), timeout=self.call_timeout
+            )
+            self._call(
+                "Emulation.setDefaultBackgroundColorOverride",
+                color={"r": 255, "g": 255, "b": 255, "a": 1},
+            )
+            self._frame_id = self._call("Page.getFrameTree")["frameTree"]["frame"]["id"]
+        except Exception:
+            self.close()
+            raise
+        logging.info(f"Render browser started (pid {self._proc.pid})")
+
+    def _wait_for_devtools_port(self):
+        # With --remote-debugging-port=0 Chromium picks a free port and
+        # announces it in DevToolsActivePort inside the profile directory.
+        port_file = os.path.join(self._user_data_dir, "DevToolsActivePort")
+        deadline = time.monotonic() + self.startup_timeout
+        while time.monotonic() < deadline:
+            if self._proc.poll() is not None:
+                raise RenderError(
+                    f"Render browser exited during startup ({self._proc.returncode})"
+                )
+            try:
+                with open(port_file, "r") as f:
+                    port = f.readline().strip()
+                if port:
+                    return int(port)
+            except FileNotFoundError:
+                pass
+            time.sleep(0.05)
+        raise RenderError("Render browser did not open a DevTools port in time")
+
+    def _page_websocket_url(self, port):
+        with urllib.request.urlopen(
+            f"http://127.0.0.1:{port}/json/list", timeout=self.call_timeout
+        ) as response:
+            targets = json.load(response)
+        for target in targets:
+            if target.get("type") == "page":
+                return target["webSocketDebuggerUrl"]
+        raise RenderError("Render browser has no page target")
+
+    def _call(self, method, **params):
+        self._message_id += 1
+        message_id = self._message_id
+        self._ws.send(
+            json.dumps({"id": message_id, "method": method, "params": params})
+        )
+        while True:
+            message = json.loads(self._ws.recv())
+            # Skip unsolicited events and answers to earlier calls
+            if message.get("id") != message_id:
+                continue
+            if "error" in message:
+                raise RenderError(f"{method} failed: {message['error']}")
+            return message.get("result", {})
+
+    def is_healthy(self):
+        if self._proc is None or self._proc.poll() is not None or self._ws is None:
+            return False
+        try:
+            self._call("Browser.getVersion")
+        except Exception as e:
+            logging.warning(f"Render browser failed health check: {e}")
+            return False
+        return True
+
+    def render(self, html_str, css_str, size):
+        """Paint the given HTML/CSS into a viewport of `size` and return PNG bytes."""
+        width, height = size
+        self._call(
+            "Emulation.setDeviceMetricsOverride",
+            width=width,
+            height=height,
+            deviceScaleFactor=1,
+            mobile=False,
+        )
+        self._call(
+            "Page.setDocumentContent",
+            frameId=self._frame_id,
+            html=(
+                f"<html><head><style>{css_str}</style></head>"
+                f"<body>{html_str}</body></html>"
+            ),
+        )
+        self._call("Runtime.evaluate", expression=_WAIT_FOR_PAINT, awaitPromise=True)
+        result = self._call(
+            "Page.captureScreenshot",
+            format="png",
+            clip={"x": 0, "y": 0, "width": width, "height": height, "scale": 1},
+        )
+        self.renders += 1
+        return base64.b64decode(result["data"])
+
+    def close(self):
+        if self._ws is not None:
+            try:
+                self._ws.close()
+            except Exception:
+                pass
+            self._ws = None
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.terminate()
+            try:
+                self._proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self._proc.kill()
+                self._proc.wait()
+        if self._user_data_dir:
+            shutil.rmtree(self._user_data_dir, ignore_errors=True)
+            self._user_data_dir = None
+
+
+class RenderPool:
+    """Bounded pool of warm render browsers shared by all label modules.
+
+    At most `size` renders run concurrently; further callers block until a
+    browser becomes free. Idle browsers are health checked before reuse and
+    replaced after `max_renders` renders to keep Chromium's memory in check.
+    """
+
+    def __init__(self, size=1, max_renders=100, executable=None):
+        self.size = size
+        self.max_renders = max_renders
+        self.executable = find_chrome(executable)
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = queue.LifoQueue()
+        self._closed = False
+
+    def _checkout(self):
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if worker.is_healthy():
+                return worker
+            worker.close()
+        worker = BrowserWorker(self.executable)
+        with tracer.span("start render browser"):
+            worker.start()
+        return worker
+
+    def _checkin(self, worker):
+        if self._closed:
+            worker.close()
+        elif worker.renders >= self.max_renders:
+            logging.info(f"Recycling render browser after {worker.renders} renders")
+            worker.close()
+        else:
+            self._idle.put(worker)
+
+    def render(self, html_str, css_str, size):
+        # Includes waiting for a free browser
+        with tracer.span("render pool"), self._slots:
+            worker = self._checkout()
+            try:
+                with tracer.span("chromium render"):
+                    png = worker.render(html_str, css_str, size)
+            except Exception:
+                # Never hand a browser in an unknown state to the next job
+                worker.close()
+                raise
+            self._checkin(worker)
+            return png
+
+    def warm_up(self):
+        """Start browsers up front so the first label doesn't pay for it."""
+        for _ in range(self.size - self._idle.qsize()):
+            worker = BrowserWorker(self.executable)
+            try:
+                worker.start()
+            except Exception as e:
+                logging.error(f"Couldn't start render browser: {e}")
+                return
+            self._checkin(worker)
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_render_pool(config):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = RenderPool(
+                size=config.RENDER_POOL_SIZE,
+                max_renders=config.RENDER_POOL_MAX_RENDERS,
+            )
+            atexit.register(_pool.close)
+        return _pool
@@ -0,0 +1,156 @@
+import functools
+import logging
+import os
+import threading
+
+from brother_ql_web.configuration import (
+    Configuration,
+    ServerConfiguration,
+    PrinterConfiguration,
+    LabelConfiguration,
+    WebsiteConfiguration,
+)
+
+from config import config
+from lead_store import LeadStore
+from lead_sync import LeadSync
+from odoo_cache import OdooCache
+from odoo_client import CircuitBreaker, OdooClient
+from print_queue import PrintQueue
+from print_spool import PrintSpool
+from printer_pool import PrinterPool
+from render_pool import get_render_pool
+from tracing import tracer
+
+# Services are created on first use and then shared by all threads
+_services = {}
+_lock = threading.RLock()
+_started_pid = None
+
+
+def _service(factory):
+    @functools.wraps(factory)
+    def get():
+        service = _services.get(factory.__name__)
+        if service is None:
+            with _lock:
+                service = _services.get(factory.__name__)
+                if service is None:
+                    service = _services[factory.__name__] = factory()
+        return service
+
+    return get
+
+
+@_service
+def get_odoo_client():
+    return OdooClient(
+        config.ODOO_URL,
+        config.ODOO_DB,
+        config.ODOO_USERNAME,
+        config.ODOO_PASSWORD,
+        pool_size=config.ODOO_POOL_SIZE,
+        timeout=config.ODOO_TIMEOUT,
+        circuit=CircuitBreaker(
+            failure_threshold=config.ODOO_CIRCUIT_FAILURES,
+            reset_timeout=config.ODOO_CIRCUIT_RESET,
+        ),
+    )
+
+
+@_service
+def get_lead_store():
+    # Collected leads, also used for the duplicate check
+    return LeadStore(config.LEAD_DB_PATH, import_csv_path=config.CSV_FILE_PATH)
+
+
+@_service
+def get_lead_sync():
+    # Leads are created in Odoo in the background, batched from the outbox
+    return LeadSync(
+        get_odoo_client(),
+        get_lead_store(),
+        config,
+        batch_size=config.ODOO_SYNC_BATCH_SIZE,
+    )
+
+
+@_service
+def get_odoo_cache():
+    # Campaign, source and tag IDs and the countries come from a local cache,
+    # refreshed in the background, so the app starts even when Odoo is down
+    return OdooCache(
+        get_odoo_client(),
+        config,
+        config.ODOO_CACHE_PATH,
+        ttl=config.ODOO_CACHE_TTL,
+        on_refresh=get_lead_sync().notify,
+    )
+
+
+@_service
+def get_printer_config():
+    return Configuration(
+        server=ServerConfiguration,
+        printer=PrinterConfiguration(
+            model="QL-820NWB", printer=f"tcp://{config.PRINTERS[0]}"
+        ),
+        label=LabelConfiguration(
+            default_size="54",
+            default_orientation="standard",
+        ),
+        website=WebsiteConfiguration,
+    )
+
+
+@_service
+def get_print_queue():
+    # All labels go through one bounded queue with one connection per printer,
+    # rendered labels are spooled to disk until a printer accepted them
+    return PrintQueue(
+        get_printer_config(),
+        PrintSpool(config.PRINT_SPOOL_PATH),
+        render_workers=config.PRINT_RENDER_WORKERS,
+        max_size=config.PRINT_QUEUE_SIZE,
+        batch_rate=config.PRINT_BATCH_RATE,
+        batch_max_pending=config.PRINT_BATCH_MAX_PENDING,
+        printers=PrinterPool(
+            config.PRINTERS,
+            strategy=config.PRINTER_DISPATCH,
+            probe_interval=config.PRINTER_PROBE_INTERVAL,
+        ),
+    )
+
+
+def start_background():
+    """Set up the services and start their background threads, once per process.
+
+    The work happens in a thread of its own, so the process serves requests
+    (and the health probe) right away. Threads don't survive a fork, so with
+    a preloaded app this has to be called in the worker.
+    """
+    global _started_pid
+    with _lock:
+        if _started_pid == os.getpid():
+            return
+        _started_pid = os.getpid()
+    threading.Thread(target=_start, name="startup", daemon=True).start()
+
+
+def background_started():
+    return _started_pid == os.getpid()
+
+
+def _start():
+    if config.TRACE_FILE_PATH:
+        tracer.export_to(config.TRACE_FILE_PATH)
+    get_lead_sync().start()
+    get_odoo_cache().start()
+    get_print_queue().start()
+
+    # Start the label render browsers so the first submission doesn't wait for them
+    if config.LABEL_RENDERER == "chromium":
+        try:
+            get_render_pool(config).warm_up()
+        except FileNotFoundError:
+            logging.error("No Chromium found, label rendering won't work")
@@ -0,0 +1,128 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+
+from flask import Response, current_app, request
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Fingerprinted URLs change with the content, so they can be cached for good
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+_COMPRESSIBLE = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+
+class _Asset:
+    def __init__(self, path, mtime, data):
+        self.path = path
+        self.mtime = mtime
+        self.digest = hashlib.sha256(data).hexdigest()[:16]
+        self.mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.compressible = self.mimetype.startswith(_COMPRESSIBLE)
+        # Only what is sent compressed is kept in memory
+        self.data = data if self.compressible else None
+        self.variants = {}
+        self._lock = threading.Lock()
+
+    def variant(self, encoding):
+        with self._lock:
+            if encoding not in self.variants:
+                if encoding == "br":
+                    self.variants[encoding] = brotli.compress(self.data, quality=11)
+                else:
+                    self.variants[encoding] = gzip.compress(
+                        self.data, compresslevel=9, mtime=0
+                    )
+            return self.variants[encoding]
+
+
+class StaticAssets:
+    """Fingerprinted URLs, cache headers and precompressed variants of static files.
+
+    url_for() adds a hash of the file content to the URLs of the app's and
+    the blueprints' static files (the Bootstrap files among them), those URLs
+    are cached by the browser for a year. Text files are compressed once and
+    sent gzip (or brotli, if installed) encoded, everything supports
+    conditional requests with an ETag.
+    """
+
+    def __init__(self, app=None):
+        self._assets = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.url_defaults(self._add_fingerprint)
+        app.before_request(self._send_compressed)
+        app.after_request(self._add_cache_headers)
+
+    def _folder(self, endpoint):
+        if endpoint == "static":
+            return current_app.static_folder
+        if endpoint and endpoint.endswith(".static"):
+            blueprint = current_app.blueprints.get(endpoint.removesuffix(".static"))
+            if blueprint is not None:
+                return blueprint.static_folder
+        return None
+
+    def _asset(self, endpoint, filename):
+        folder = self._folder(endpoint)
+        path = safe_join(folder, filename) if folder and filename else None
+        if path is None or not os.path.isfile(path):
+            return None
+        mtime = os.stat(path).st_mtime_ns
+        asset = self._assets.get(path)
+        if asset is None or asset.mtime != mtime:
+            with open(path, "rb") as file:
+                asset = _Asset(path, mtime, file.read())
+            with self._lock:
+                self._assets[path] = asset
+        return asset
+
+    def _request_asset(self):
+        return self._asset(request.endpoint, (request.view_args or {}).get("filename"))
+
+    def _add_fingerprint(self, endpoint, values):
+        asset = self._asset(endpoint, values.get("filename"))
+        if asset is not None:
+            values.setdefault("v", asset.digest)
+
+    def _send_compressed(self):
+        if request.method not in ("GET", "HEAD") or "Range" in request.headers:
+            return None
+        asset = self._request_asset()
+        if asset is None or not asset.compressible:
+            return None
+        encodings = ["br", "gzip"] if brotli is not None else ["gzip"]
+        encoding = request.accept_encodings.best_match(encodings)
+        if encoding is None:
+            return None
+
+        response = Response(asset.variant(encoding), mimetype=asset.mimetype)
+        response.content_encoding = encoding
+        response.set_etag(f"{asset.digest}-{encoding}")
+        response.last_modified = asset.mtime / 1e9
+        return response.make_conditional(request)
+
+    def _add_cache_headers(self, response):
+        asset = self._request_asset()
+        if asset is None:
+            return response
+        if asset.compressible:
+            response.vary.add("Accept-Encoding")
+        if request.args.get("v") == asset.digest:
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+        else:
+            # Without the fingerprint the browser has to ask, an ETag makes that cheap
+            response.cache_control.no_cache = True
+        return response
@@ -0,0 +1,176 @@
+import contextvars
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+# Spans waiting to be written, newer ones are dropped while the file lags behind
+_QUEUE_SIZE = 10000
+_BATCH_SIZE = 256
+
+# OpenTelemetry span kinds
+INTERNAL = 1
+SERVER = 2
+CLIENT = 3
+
+_current = contextvars.ContextVar("span", default=None)
+
+
+def _attribute(key, value):
+    if isinstance(value, bool):
+        value = {"boolValue": value}
+    elif isinstance(value, int):
+        value = {"intValue": str(value)}
+    elif isinstance(value, float):
+        value = {"doubleValue": value}
+    else:
+        value = {"stringValue": str(value)}
+    return {"key": key, "value": value}
+
+
+class Span:
+    """One timed phase of a trace, with the IDs OpenTelemetry uses."""
+
+    def __init__(self, name, parent=None, links=(), attributes=None, kind=INTERNAL):
+        self.name = name
+        self.kind = kind
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.links = [link for link in links if link is not None]
+        self.attributes = dict(attributes or {})
+        self.error = None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.token = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_error(self, error):
+        self.error = f"{type(error).__name__}: {error}"
+
+    def otlp(self):
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [_attribute(*item) for item in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.links:
+            span["links"] = [
+                {"traceId": link.trace_id, "spanId": link.span_id}
+                for link in self.links
+            ]
+        return span
+
+
+class Tracer:
+    """Collects spans and appends them to a file, one OTLP/JSON export per line.
+
+    That is the format the OpenTelemetry collector's otlpjsonfile receiver
+    reads, so the traces can be forwarded to any tracing backend. Until
+    export_to() was called, spans cost next to nothing and aren't recorded.
+    """
+
+    def __init__(self, service_name="contactform"):
+        self.service_name = service_name
+        self._queue = None
+        self.dropped = 0
+
+    def export_to(self, path):
+        if self._queue is not None:
+            return
+        self._queue = queue.Queue(maxsize=_QUEUE_SIZE)
+        threading.Thread(
+            target=self._export_loop, args=(path,), name="tracing", daemon=True
+        ).start()
+        logging.info(f"Writing traces to {path}")
+
+    @contextmanager
+    def span(self, name, parent=None, links=(), attributes=None, kind=INTERNAL):
+        """Time the with block as a span, a child of the given or current span."""
+        if self._queue is None:
+            yield None
+            return
+        span = Span(name, parent or _current.get(), links, attributes, kind)
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set_error(e)
+            raise
+        finally:
+            _current.reset(token)
+            self.end(span)
+
+    def start(self, name, attributes=None, kind=INTERNAL):
+        """Start a span that is ended by finish(), e.g. in a request teardown."""
+        if self._queue is None:
+            return None
+        span = Span(name, _current.get(), attributes=attributes, kind=kind)
+        span.token = _current.set(span)
+        return span
+
+    def finish(self, span, error=None):
+        if span is None:
+            return
+        if error is not None:
+            span.set_error(error)
+        _current.reset(span.token)
+        self.end(span)
+
+    def end(self, span):
+        span.end_ns = time.time_ns()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _export(self, spans):
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [_attribute("service.name", self.service_name)]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": self.service_name},
+                            "spans": [span.otlp() for span in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+
+    def _export_loop(self, path):
+        while True:
+            spans = [self._queue.get()]
+            while len(spans) < _BATCH_SIZE:
+                try:
+                    spans.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with open(path, "a") as file:
+                    file.write(json.dumps(self._export(spans)) + "\n")
+            except OSError as e:
+                logging.error(f"Couldn't write {len(spans)} spans to {path}: {e}")
+
+
+tracer = Tracer()
+
+
+def current():
+    """The span of the running phase, to continue its trace in another thread."""
+    return _current.get()
@@ -1,5 +1,3 @@
-import csv
-import os
 import random
 
 from flask import Response, request
@@ -8,30 +6,8 @@ from functools import wraps
 from config import config
 
 
-# Function to append data to the CSV file
-def append_to_csv(data, file_path):
-    file_exists = os.path.isfile(file_path)
-    with open(file_path, mode="a", newline="") as csv_file:
-        fieldnames = [
-            "Opportunity",
-            "Contact Name",
-            "Email",
-            "Job Position",
-            "Company Name",
-            "Country",
-            "Phone",
-            "Notes",
-            "Tags",
-            "Campaign",
-            "Source",
-            "VoucherCode",
-        ]
-        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-
-        if not file_exists:
-            writer.writeheader()
-
-        writer.writerow(data)
+def normalize_email(email):
+    return email.strip().lower()
 
 
 def check_auth(username, password):
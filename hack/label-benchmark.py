@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+"""Benchmark the label path: render, rasterize and send to a fake printer.
+
+A local TCP server stands in for the QL-820NWB and times the raster stream
+it receives. For every renderer and label kind the script reports the
+p50/p95 render time, the raster size, the bytes that went over the wire,
+how long sending took and the peak RSS of the process and its browsers.
+
+    python hack/label-benchmark.py --renderers pillow,chromium -n 50
+    python hack/label-benchmark.py --json baseline.json
+    python hack/label-benchmark.py --compare baseline.json
+
+With --compare it exits non-zero if a p95 render time got worse than the
+baseline by more than --tolerance.
+"""
+
+import argparse
+import json
+import os
+import resource
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+CONTACTFORM = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "contactform"
+)
+
+LABELS = ("raffle", "appuio", "servala")
+
+
+class FakePrinter:
+    """Accepts raster streams like the printer's port 9100 and times them."""
+
+    def __init__(self):
+        self.socket = socket.create_server(("127.0.0.1", 0))
+        self.port = self.socket.getsockname()[1]
+        self.jobs = []
+        self._received = threading.Condition()
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            connection, _ = self.socket.accept()
+            with connection:
+                received = 0
+                first_byte = None
+                while data := connection.recv(65536):
+                    if first_byte is None:
+                        first_byte = time.monotonic()
+                    received += len(data)
+                finished = time.monotonic()
+            with self._received:
+                self.jobs.append((received, finished - (first_byte or finished)))
+                self._received.notify_all()
+
+    def wait_for(self, count, timeout=10):
+        """Return the (bytes, seconds) of the count-th job once it arrived."""
+        with self._received:
+            if not self._received.wait_for(lambda: len(self.jobs) >= count, timeout):
+                raise RuntimeError("The fake printer didn't receive the label")
+            return self.jobs[count - 1]
+
+
+def tree_rss_kb(pid=None):
+    """RSS of this process and all its descendants (the render browsers), Linux only."""
+    pid = pid or os.getpid()
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as file:
+                ppid = int(file.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        try:
+            with open(f"/proc/{current}/status") as file:
+                for line in file:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+
+def percentile(values, p):
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1]
+
+
+def setup_environment(printer_port, tmp):
+    # The config needs these, nothing talks to Odoo during the benchmark
+    for name in (
+        "FLASK_APP_SECRET_KEY",
+        "ODOO_URL",
+        "ODOO_DB",
+        "ODOO_USERNAME",
+        "ODOO_PASSWORD",
+        "TAG_NAME",
+        "CAMPAIGN_NAME",
+        "SOURCE_NAME",
+        "BASIC_AUTH_USERNAME",
+        "BASIC_AUTH_PASSWORD",
+    ):
+        os.environ.setdefault(name, "benchmark")
+    os.environ.setdefault("SERVALA_VOUCHER_CODE", "BENCHMARK")
+    os.environ["PRINTER_IP"] = f"127.0.0.1:{printer_port}"
+    os.environ["CONFIG_FILE_PATH"] = os.path.join(tmp, "config.json")
+    os.environ["LOG_LEVEL"] = "WARNING"
+    sys.path.insert(0, CONTACTFORM)
+
+
+def label_jobs(kind, i, config, printer_config):
+    from label_raffle import render_raffle
+    from label_voucher import render_appuio_voucher, render_servala_voucher
+
+    # A different visitor every time, as at the booth
+    name = f"Visitor Number {i}"
+    code = f"{i:06d}"
+    if kind == "raffle":
+        return render_raffle, (name, code, config, printer_config)
+    if kind == "appuio":
+        return render_appuio_voucher, (
+            name,
+            f"Company {i}",
+            f"visitor{i}@example.com",
+            "+41 44 000 00 00",
+            code,
+            config,
+            printer_config,
+        )
+    return render_servala_voucher, (name, code, config, printer_config)
+
+
+def benchmark(renderer, kind, iterations, warmup, printer):
+    from config import config
+    from printer import send_label
+    from services import get_printer_config
+
+    config.LABEL_RENDERER = renderer
+    printer_config = get_printer_config()
+    render_seconds = []
+    send_seconds = []
+    wire_seconds = []
+    raster_bytes = []
+    wire_bytes = []
+    peak_rss = 0
+    for i in range(warmup + iterations):
+        render, args = label_jobs(kind, i, config, printer_config)
+        started = time.perf_counter()
+        data = render(*args)
+        rendered = time.perf_counter()
+        expected_jobs = len(printer.jobs) + 1
+        send_label(data, printer_config)
+        sent = time.perf_counter()
+        received, receive_seconds = printer.wait_for(expected_jobs)
+        peak_rss = max(peak_rss, tree_rss_kb())
+        if i < warmup:
+            continue
+        render_seconds.append(rendered - started)
+        send_seconds.append(sent - rendered)
+        wire_seconds.append(receive_seconds)
+        raster_bytes.append(len(data))
+        wire_bytes.append(received)
+
+    return {
+        "renderer": renderer,
+        "label": kind,
+        "iterations": iterations,
+        "render_ms_p50": percentile(render_seconds, 50) * 1000,
+        "render_ms_p95": percentile(render_seconds, 95) * 1000,
+        "send_ms_p50": percentile(send_seconds, 50) * 1000,
+        "send_ms_p95": percentile(send_seconds, 95) * 1000,
+        "printer_receive_ms_p50": percentile(wire_seconds, 50) * 1000,
+        "raster_bytes": max(raster_bytes),
+        "wire_bytes": max(wire_bytes),
+        "peak_tree_rss_mb": peak_rss / 1024,
+    }
+
+
+def print_table(results):
+    columns = (
+        ("renderer", "renderer", "{}"),
+        ("label", "label", "{}"),
+        ("render_ms_p50", "render p50 ms", "{:.1f}"),
+        ("render_ms_p95", "render p95 ms", "{:.1f}"),
+        ("send_ms_p50", "send p50 ms", "{:.2f}"),
+        ("send_ms_p95", "send p95 ms", "{:.2f}"),
+        ("raster_bytes", "raster bytes", "{}"),
+        ("wire_bytes", "wire bytes", "{}"),
+        ("peak_tree_rss_mb", "peak RSS MB", "{:.0f}"),
+    )
+    rows = [[title for _, title, _ in columns]]
+    for result in results:
+        rows.append([fmt.format(result[key]) for key, _, fmt in columns])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print("  ".join(value.rjust(width) for value, width in zip(row, widths)))
+
+
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path) as file:
+        baseline = {(r["renderer"], r["label"]): r for r in json.load(file)["results"]}
+    regressions = []
+    for result in results:
+        before = baseline.get((result["renderer"], result["label"]))
+        if before is None:
+            continue
+        limit = before["render_ms_p95"] * (1 + tolerance)
+        if result["render_ms_p95"] > limit:
+            regressions.append(
+                f"{result['renderer']}/{result['label']}: render p95"
+                f" {result['render_ms_p95']:.1f}ms, baseline {before['render_ms_p95']:.1f}ms"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--renderers", default="pillow,chromium")
+    parser.add_argument("--labels", default=",".join(LABELS))
+    parser.add_argument("-n", "--iterations", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="baseline written with --json before")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    printer = FakePrinter()
+    tmp = tempfile.mkdtemp(prefix="label-benchmark-")
+    setup_environment(printer.port, tmp)
+
+    results = []
+    for renderer in args.renderers.split(","):
+        for kind in args.labels.split(","):
+            try:
+                results.append(
+                    benchmark(renderer, kind, args.iterations, args.warmup, printer)
+                )
+            except FileNotFoundError as e:
+                # No Chromium installed
+                print(f"Skipping {renderer}/{kind}: {e}", file=sys.stderr)
+                break
+
+    print_table(results)
+    print(
+        f"\npeak RSS of the benchmark process: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB"
+    )
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"created": time.time(), "results": results}, file, indent=4)
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+"""Load test the contact form submission path.
+
+Every simulated tablet repeatedly loads the form, takes the CSRF token from
+it and submits a lead, like a visitor at the booth. Odoo and the printer are
+replaced by local stubs, the app runs in this process with a threaded
+server, so the numbers show what the form itself can handle:
+
+    python hack/load-test.py --concurrency 8 --duration 30
+    python hack/load-test.py --concurrency 4 --duplicates 0.2 --odoo-latency 0.3
+
+The app takes the rest of its configuration from the environment as usual,
+e.g. LABEL_RENDERER=pillow where there is no Chromium, or
+ODOO_CREATELEAD_ENABLED=false to leave out Odoo.
+
+To load a running app (e.g. gunicorn on the Pi), start the stubs on their
+own, point the app's ODOO_URL and PRINTER_IP to them and pass its URL:
+
+    python hack/load-test.py --stubs-only
+    python hack/load-test.py --url http://raspberrypi:8000 --concurrency 8
+"""
+
+import argparse
+import collections
+import os
+import random
+import re
+import socket
+import socketserver
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import xmlrpc.server
+
+import requests
+
+CONTACTFORM = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "contactform"
+)
+
+COUNTRIES = ["Switzerland", "Germany", "Austria", "France", "Italy", "Spain"]
+
+_CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+class StubOdoo(socketserver.ThreadingMixIn, xmlrpc.server.SimpleXMLRPCServer):
+    """Answers the XML-RPC calls of the contactform, with an optional delay."""
+
+    daemon_threads = True
+
+    class Handler(xmlrpc.server.SimpleXMLRPCRequestHandler):
+        rpc_paths = ("/xmlrpc/2/common", "/xmlrpc/2/object")
+        # Keep-alive, like the real Odoo
+        protocol_version = "HTTP/1.1"
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0):
+        super().__init__((host, port), self.Handler, logRequests=False, allow_none=True)
+        self.latency = latency
+        self.leads = 0
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+        self.register_function(self.authenticate)
+        self.register_function(self.execute_kw)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def authenticate(self, db, login, password, context):
+        return 2
+
+    def execute_kw(self, db, uid, password, model, method, args, kwargs=None):
+        time.sleep(self.latency)
+        with self._lock:
+            self.calls[f"{model}.{method}"] += 1
+        if method == "search_read" and model == "res.country":
+            return [{"id": i, "name": name} for i, name in enumerate(COUNTRIES, 1)]
+        if method == "search_read":
+            # Domains like [("name", "in", names)] or [("name", "=", name)]
+            _, operator, value = args[0][0]
+            names = value if operator == "in" else [value]
+            return [{"id": i, "name": name} for i, name in enumerate(names, 1)]
+        if method == "create":
+            records = args[0] if isinstance(args[0], list) else [args[0]]
+            with self._lock:
+                first = self.leads + 1
+                self.leads += len(records)
+            ids = list(range(first, first + len(records)))
+            return ids if isinstance(args[0], list) else ids[0]
+        raise xmlrpc.server.Fault(1, f"{model}.{method} isn't stubbed")
+
+
+class StubPrinter:
+    """Accepts raster streams on a TCP port like the label printer does."""
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.socket = socket.create_server((host, port))
+        self.port = self.socket.getsockname()[1]
+        self.labels = 0
+        self.bytes = 0
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            connection, _ = self.socket.accept()
+            received = 0
+            with connection:
+                while data := connection.recv(65536):
+                    received += len(data)
+            # Health probes of the printer pool connect without sending anything
+            if received:
+                self.bytes += received
+                self.labels += 1
+
+
+def start_app(odoo, printer, tmp):
+    """Serve the contactform from this process, configured for the stubs."""
+    from werkzeug.serving import make_server
+
+    os.environ.update(
+        ODOO_URL=f"http://127.0.0.1:{odoo.server_address[1]}",
+        PRINTER_IP=f"127.0.0.1:{printer.port}",
+        LEAD_DB_PATH=os.path.join(tmp, "leads.sqlite"),
+        PRINT_SPOOL_PATH=os.path.join(tmp, "print_spool.sqlite"),
+        ODOO_CACHE_PATH=os.path.join(tmp, "odoo_cache.json"),
+        CONFIG_FILE_PATH=os.path.join(tmp, "config.json"),
+        CSV_FILE_PATH="",
+    )
+    for name in (
+        "FLASK_APP_SECRET_KEY",
+        "ODOO_DB",
+        "ODOO_USERNAME",
+        "ODOO_PASSWORD",
+        "TAG_NAME",
+        "CAMPAIGN_NAME",
+        "SOURCE_NAME",
+        "BASIC_AUTH_USERNAME",
+        "BASIC_AUTH_PASSWORD",
+    ):
+        os.environ.setdefault(name, "loadtest")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    sys.path.insert(0, CONTACTFORM)
+
+    from app import app
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+class Results:
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.outcomes = collections.Counter()
+        self._lock = threading.Lock()
+
+    def add(self, request, seconds, outcome):
+        with self._lock:
+            self.latencies[request].append(seconds)
+            self.outcomes[outcome] += 1
+
+
+def submit(session, url, email, results):
+    started = time.perf_counter()
+    try:
+        page = session.get(url, timeout=30)
+    except requests.RequestException as e:
+        results.add("GET /", time.perf_counter() - started, type(e).__name__)
+        return
+    loaded = time.perf_counter()
+    token = _CSRF_TOKEN.search(page.text) if page.status_code == 200 else None
+    if token is None:
+        results.add("GET /", loaded - started, f"GET {page.status_code}")
+        return
+    results.add("GET /", loaded - started, "form loaded")
+
+    data = {
+        "csrf_token": token.group(1),
+        "name": "Load Test",
+        "email": email,
+        "company": "Load Test AG",
+        "job_position": "Tester",
+        "phone": "+41 44 000 00 00",
+        "country": str(random.randint(1, len(COUNTRIES))),
+        "notes": "Submitted by hack/load-test.py",
+    }
+    try:
+        response = session.post(url, data=data, allow_redirects=False, timeout=30)
+    except requests.RequestException as e:
+        results.add("POST /", time.perf_counter() - loaded, type(e).__name__)
+        return
+    elapsed = time.perf_counter() - loaded
+    location = response.headers.get("Location", "")
+    if response.status_code == 302 and "go.vshn.ch" in location:
+        outcome = "submitted"
+    elif response.status_code == 302:
+        outcome = "duplicate"
+    else:
+        outcome = f"POST {response.status_code}"
+    results.add("POST /", elapsed, outcome)
+
+
+def tablet(number, url, deadline, remaining, duplicates, results):
+    session = requests.Session()
+    submitted = []
+    while time.monotonic() < deadline:
+        with remaining["lock"]:
+            if remaining["count"] == 0:
+                return
+            remaining["count"] -= 1
+        if submitted and random.random() < duplicates:
+            email = random.choice(submitted)
+        else:
+            email = (
+                f"tablet{number}-{len(submitted)}-{random.getrandbits(32)}@example.com"
+            )
+            submitted.append(email)
+        submit(session, url, email, results)
+
+
+def percentile(values, p):
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1]
+
+
+def report(results, elapsed):
+    requests_made = sum(len(values) for values in results.latencies.values())
+    submissions = len(results.latencies["POST /"])
+    print(f"{submissions} submissions in {elapsed:.1f}s: {submissions / elapsed:.1f}/s")
+    print()
+    print(
+        f"{'request':>8}  {'count':>6}  {'p50 ms':>8}  {'p95 ms':>8}  {'p99 ms':>8}  {'max ms':>8}"
+    )
+    for request, values in sorted(results.latencies.items()):
+        print(
+            f"{request:>8}  {len(values):>6}"
+            f"  {percentile(values, 50) * 1000:>8.1f}"
+            f"  {percentile(values, 95) * 1000:>8.1f}"
+            f"  {percentile(values, 99) * 1000:>8.1f}"
+            f"  {max(values) * 1000:>8.1f}"
+        )
+    print()
+    expected = {"form loaded", "submitted", "duplicate"}
+    errors = sum(
+        count for outcome, count in results.outcomes.items() if outcome not in expected
+    )
+    for outcome, count in results.outcomes.most_common():
+        print(f"{outcome:>16}: {count}")
+    print(f"{'error rate':>16}: {errors / max(requests_made, 1):.2%}")
+
+
+def wait_for_background(timeout):
+    """Wait until the app created all leads in Odoo and printed all labels."""
+    from services import get_lead_sync, get_print_queue
+
+    started = time.monotonic()
+    while time.monotonic() - started < timeout:
+        queue_stats = get_print_queue().stats()
+        if (
+            queue_stats["rendering"] == 0
+            and queue_stats["spooled"] == 0
+            and get_lead_sync().stats()["pending"] == 0
+        ):
+            break
+        time.sleep(0.1)
+    return time.monotonic() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("-c", "--concurrency", type=int, default=4, help="tablets")
+    parser.add_argument("-d", "--duration", type=float, default=20, help="seconds")
+    parser.add_argument("-n", "--submissions", type=int, help="stop after as many")
+    parser.add_argument(
+        "--duplicates", type=float, default=0.0, help="share of repeated e-mails"
+    )
+    parser.add_argument(
+        "--odoo-latency", type=float, default=0.05, help="seconds per Odoo call"
+    )
+    parser.add_argument(
+        "--drain-timeout",
+        type=float,
+        default=60,
+        help="seconds to wait for the leads and labels after the load",
+    )
+    parser.add_argument("--url", help="load a running app instead")
+    parser.add_argument(
+        "--stubs-only", action="store_true", help="only run the Odoo and printer stubs"
+    )
+    parser.add_argument("--odoo-port", type=int, default=0)
+    parser.add_argument("--printer-port", type=int, default=0)
+    args = parser.parse_args()
+
+    odoo = StubOdoo(port=args.odoo_port, latency=args.odoo_latency)
+    printer = StubPrinter(port=args.printer_port)
+    if args.stubs_only:
+        print(f"ODOO_URL=http://127.0.0.1:{odoo.server_address[1]}")
+        print(f"PRINTER_IP=127.0.0.1:{printer.port}")
+        try:
+            while True:
+                time.sleep(10)
+                print(f"{odoo.leads} leads, {printer.labels} labels", flush=True)
+        except KeyboardInterrupt:
+            return
+
+    url = args.url or start_app(odoo, printer, tempfile.mkdtemp(prefix="load-test-"))
+    # Start the background workers and wait for the Odoo data, a running app
+    # talks to its own Odoo instead of the stub
+    session = requests.Session()
+    for _ in range(100):
+        ready = session.get(url, timeout=30).status_code == 200
+        if ready and (args.url or odoo.calls):
+            break
+        time.sleep(0.1)
+
+    results = Results()
+    remaining = {"lock": threading.Lock(), "count": args.submissions or -1}
+    deadline = time.monotonic() + args.duration
+    started = time.perf_counter()
+    threads = [
+        threading.Thread(
+            target=tablet,
+            args=(i, url, deadline, remaining, args.duplicates, results),
+        )
+        for i in range(args.concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    report(results, elapsed)
+    if args.url:
+        return
+
+    from services import get_print_queue
+
+    drained = wait_for_background(args.drain_timeout)
+    queue_stats = get_print_queue().stats()
+    print()
+    print(f"{odoo.leads} leads in Odoo, {printer.labels} labels printed")
+    print(
+        f"{queue_stats['rejected']} labels rejected by the full print queue,"
+        f" {queue_stats['failed']} failed to render"
+    )
+    print(f"background work done {drained:.1f}s after the load ended")
+    print(f"Odoo calls: {dict(odoo.calls)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+import os
+import sys
+import tempfile
+
+# The app modules import each other as top-level modules, as in the image
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "contactform"))
+
+_data = tempfile.mkdtemp(prefix="contactform-test-")
+for name, value in {
+    "FLASK_APP_SECRET_KEY": "test",
+    "PRINTER_IP": "127.0.0.1:9",
+    "ODOO_URL": "http://127.0.0.1:9",
+    "ODOO_DB": "odoo",
+    "ODOO_USERNAME": "contactform",
+    "ODOO_PASSWORD": "secret",
+    "TAG_NAME": "Conference",
+    "CAMPAIGN_NAME": "Conference",
+    "SOURCE_NAME": "Booth",
+    "BASIC_AUTH_USERNAME": "admin",
+    "BASIC_AUTH_PASSWORD": "secret",
+    "LABEL_RENDERER": "pillow",
+    "LEAD_DB_PATH": os.path.join(_data, "leads.sqlite"),
+    "PRINT_SPOOL_PATH": os.path.join(_data, "print_spool.sqlite"),
+    "ODOO_CACHE_PATH": os.path.join(_data, "odoo_cache.json"),
+    "CONFIG_FILE_PATH": os.path.join(_data, "config.json"),
+}.items():
+    os.environ.setdefault(name, value)
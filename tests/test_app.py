@@ -0,0 +1,18 @@
+import pytest
+
+from app import create_app
+
+
+@pytest.fixture
+def client():
+    app = create_app()
+    app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    return app.test_client()
+
+
+def test_form_without_csrf(client):
+    response = client.get("/")
+
+    assert response.status_code == 200
+    assert "ETag" not in response.headers
+    assert b"<form" in response.data
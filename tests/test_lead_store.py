@@ -0,0 +1,19 @@
+import csv
+import logging
+
+from lead_store import CSV_FIELDNAMES, LeadStore
+
+
+def test_import_csv_counts_skipped_duplicates(tmp_path, caplog):
+    path = tmp_path / "leads.csv"
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, CSV_FIELDNAMES)
+        writer.writeheader()
+        for email in ("one@example.com", "two@example.com", "One@Example.com"):
+            writer.writerow({"Email": email})
+
+    with caplog.at_level(logging.INFO):
+        LeadStore(str(tmp_path / "leads.sqlite"), import_csv_path=str(path))
+
+    assert f"Imported 2 leads from {path}" in caplog.text
+    assert f"Skipped 1 leads from {path}" in caplog.text
@@ -0,0 +1,43 @@
+import types
+
+from lead_store import LeadStore
+from lead_sync import LeadSync
+
+
+class FakeOdoo:
+    def __init__(self, error):
+        self.error = error
+        self.created = []
+
+    def create_many(self, model, records):
+        if any(record["email_from"] == "bad@example.com" for record in records):
+            raise self.error
+        self.created += records
+        return list(range(len(records)))
+
+
+def _sync(tmp_path, error):
+    store = LeadStore(str(tmp_path / "leads.sqlite"))
+    for email in ("one@example.com", "bad@example.com", "two@example.com"):
+        store.add({"Email": email}, {"email_from": email})
+    config = types.SimpleNamespace(CAMPAIGN_ID=1, SOURCE_ID=2, TAG_ID=3)
+    odoo = FakeOdoo(error)
+    LeadSync(odoo, store, config)._sync(store.outbox_due(10))
+    return odoo, store
+
+
+def test_bad_record_does_not_block_the_batch(tmp_path):
+    odoo, store = _sync(tmp_path, TypeError("cannot marshal <class 'object'>"))
+
+    assert [r["email_from"] for r in odoo.created] == [
+        "one@example.com",
+        "two@example.com",
+    ]
+    assert store.outbox_stats()["pending"] == 1
+
+
+def test_unreachable_odoo_retries_the_whole_batch(tmp_path):
+    odoo, store = _sync(tmp_path, ConnectionRefusedError())
+
+    assert odoo.created == []
+    assert store.outbox_stats()["pending"] == 3